@@ -1,14 +1,106 @@
 import os
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+import io
+import json
+import click
+from flask import (Flask, Response, render_template, request, jsonify, session, redirect, url_for, abort,
+                   send_file, stream_with_context)
 from werkzeug.middleware.proxy_fix import ProxyFix
-from captcha_generator import generate_captcha, regenerate_captcha
-from database import init_app, store_captcha, store_response, get_captcha, get_most_common_response
+from captcha_generator import (generate_captcha, regenerate_captcha, render_cache, render_key, render_etag,
+                               encoder_report, render_memory_report, expected_count as seed_expected_count,
+                               DEFAULT_ENCODER, ENCODERS)
+from captcha_pool import init_app as init_pool, get_pool
+from catalog import init_app as init_catalog, get_catalog, DIFFICULTIES
+from captcha_tokens import issue_token, load_token, issue_ticket, load_ticket, issue_board_token, load_board_token
+from game import Board
+from metrics import init_app as init_metrics
+from pack import init_app as init_pack, get_pack
+from ratelimit import init_app as init_rate_limit
+from replay_cache import init_app as init_replay_cache, get_replay_cache
+from retention import init_app as init_retention
+from database import (init_app, store_captcha, get_or_create_captcha, store_response, get_captcha,
+                      get_most_common_response, consume_captcha, consume_token)
 
 # Create the Flask application
 app = Flask(__name__, instance_relative_config=True)
 app.config.from_mapping(
     SECRET_KEY='dev',
     DATABASE=os.path.join(app.instance_path, 'geometric_captcha.sqlite'),
+    # Background pre-rendering; set CAPTCHA_POOL_WORKERS to 0 to render inline
+    CAPTCHA_POOL_WORKERS=2,
+    CAPTCHA_POOL_LOW_WATERMARK=8,
+    CAPTCHA_POOL_HIGH_WATERMARK=32,
+    # Byte budget of the in-process cache of rendered images
+    RENDER_CACHE_MAX_BYTES=64 * 1024 * 1024,
+    # How long browsers and CDNs may cache a challenge image (seconds)
+    CAPTCHA_IMAGE_MAX_AGE=3600,
+    # Image encoders offered to clients, in order of preference; the first
+    # one is also used by the pre-rendering pool
+    CAPTCHA_IMAGE_FORMATS=['png-gray', 'webp'],
+    # Keep one SQLite connection per worker thread instead of one per request
+    DATABASE_REUSE_CONNECTIONS=True,
+    # Queue responses and insert them in batches from a background thread
+    DATABASE_WRITE_BEHIND=False,
+    DATABASE_WRITE_BEHIND_BATCH_SIZE=100,
+    DATABASE_WRITE_BEHIND_INTERVAL=0.5,
+    # Spread captchas and responses over this many database files, named by
+    # DATABASE_SHARD_PATH; 'flask shard-db' copies DATABASE into them
+    DATABASE_SHARDS=1,
+    DATABASE_SHARD_PATH=os.path.join(app.instance_path, 'geometric_captcha-{shard}.sqlite'),
+    # Days raw responses and captchas are kept before being rolled up into
+    # the daily tables and deleted (None keeps them forever), how often the
+    # background compaction runs (seconds), and rows deleted per transaction
+    RETENTION_RESPONSES_DAYS=None,
+    RETENTION_CAPTCHAS_DAYS=None,
+    RETENTION_INTERVAL=3600,
+    RETENTION_BATCH_SIZE=500,
+    RETENTION_BATCH_PAUSE=0.05,
+    # Issue signed challenge tokens instead of storing each challenge; the
+    # database is only written when a response is recorded
+    CAPTCHA_STATELESS=False,
+    # How long a challenge token stays valid (seconds)
+    CAPTCHA_TOKEN_MAX_AGE=600,
+    # Consumed challenges remembered per process, and for how long
+    # (seconds), so replays are rejected without a database query
+    CAPTCHA_REPLAY_CACHE_SIZE=100000,
+    CAPTCHA_REPLAY_CACHE_TTL=3600,
+    # Async serving (asgi.py): render processes, renders allowed in flight
+    # before generate answers 503, database threads and the Retry-After hint
+    ASGI_RENDER_WORKERS=2,
+    ASGI_MAX_INFLIGHT_RENDERS=4,
+    ASGI_DB_THREADS=8,
+    ASGI_RETRY_AFTER=1,
+    # Record timings and counters and serve them from /metrics
+    METRICS_ENABLED=False,
+    # Per-IP token buckets, shared by the workers on a host through
+    # RATE_LIMIT_FILE: tokens refilled per second and burst size per endpoint.
+    # A batch costs one token per challenge, so its burst covers the largest
+    # batch. Image routes render on a cache miss, so they are limited too,
+    # with room for a refetch per challenge. Idle buckets are reused after
+    # RATE_LIMIT_IDLE_AFTER seconds
+    RATE_LIMIT_ENABLED=False,
+    RATE_LIMITS={
+        'create_captcha': (1.0, 20),
+        'create_captcha_batch': (1.0, 50),
+        'verify_captcha': (2.0, 30),
+        'captcha_image': (2.0, 40),
+        'captcha_token_image': (2.0, 40),
+        'create_asteroids': (1.0, 20),
+        'verify_asteroids': (2.0, 30),
+    },
+    RATE_LIMIT_FILE=os.path.join(app.instance_path, 'ratelimit.bin'),
+    RATE_LIMIT_SLOTS=65536,
+    RATE_LIMIT_IDLE_AFTER=600,
+    # Challenge pack written by 'flask generate-pack'; when it exists,
+    # challenges are served from it instead of being rendered
+    CAPTCHA_PACK=os.path.join(app.instance_path, 'challenges.pack'),
+    # Seed catalog written by 'flask build-catalog'; when it exists, a
+    # ?difficulty= of easy, medium or hard picks a seed from that bucket
+    CAPTCHA_CATALOG=os.path.join(app.instance_path, 'catalog.sqlite'),
+    # Largest number of challenges one /generate-captcha/batch call may stream
+    CAPTCHA_BATCH_MAX_COUNT=50,
+    # Asteroids per board of the asteroid challenge; larger boards are
+    # spread over a larger space, so each asteroid has as many conflicts
+    ASTEROIDS_COUNT=64,
 )
 
 # Ensure the instance folder exists
@@ -20,6 +112,30 @@ except OSError:
 # Initialize the database with the app
 init_app(app)
 
+# Expire old captchas and responses
+init_retention(app)
+
+# Remember consumed challenges
+init_replay_cache(app)
+
+# Initialize instrumentation before any request is served
+init_metrics(app)
+
+# Reject clients over their rate limit before any rendering happens
+init_rate_limit(app)
+
+# Map the pre-generated challenge pack, if there is one
+init_pack(app)
+
+# Open the seed catalog, if there is one
+init_catalog(app)
+
+# Initialize the pre-rendered CAPTCHA pool
+init_pool(app)
+
+# Size the render cache shared by the image endpoint
+render_cache.resize(app.config['RENDER_CACHE_MAX_BYTES'])
+
 # Fix for getting real IP behind proxies
 app.wsgi_app = ProxyFix(app.wsgi_app)
 
@@ -27,52 +143,323 @@ app.wsgi_app = ProxyFix(app.wsgi_app)
 def index():
     return render_template('index.html', userCoords={'x': [7, 9], 'y': [7, 9]})
 
-@app.route('/generate-captcha', methods=['POST'])
-def create_captcha():
-    captcha_data = generate_captcha()
+def start_challenge(captcha_data, session):
+    """Record a new challenge in the session and return the response payload"""
+    if app.config['CAPTCHA_STATELESS']:
+        token = issue_token(captcha_data)
+        session.pop('captcha_id', None)
+        session['captcha_token'] = token
+        return {
+            'captcha_id': token,
+            'image_url': url_for('captcha_token_image', token=token)
+        }
+    
     captcha_id = store_captcha(captcha_data['seed'], captcha_data['expected_count'])
     
     # Store the captcha ID in the session
+    session.pop('captcha_token', None)
     session['captcha_id'] = captcha_id
     
-    return jsonify({
+    return {
         'captcha_id': captcha_id,
-        'image_data': captcha_data['image_data']
-    })
+        'image_url': url_for('captcha_image', captcha_id=captcha_id)
+    }
 
-@app.route('/verify-captcha', methods=['POST'])
-def verify_captcha():
-    user_count = request.json.get('count')
+def select_challenge(difficulty=None):
+    """
+    Pick the next challenge without rendering it: a seed from the seed
+    catalog when a difficulty is requested, otherwise a pack record or a
+    ready challenge of the pre-rendering pool. Returns (captcha_data, seed);
+    captcha_data is None when the challenge still has to be rendered from
+    seed, or from a fresh seed when seed is None too. Shared with asgi.py
+    """
+    catalog = get_catalog()
+    seed = catalog.random_seed(difficulty) if catalog and difficulty else None
+    if seed:
+        # Catalog seeds are served by seed, so repeats come from the render cache
+        return render_cache.get(render_key(seed, encoder=app.config['CAPTCHA_IMAGE_FORMATS'][0])), seed
+    
+    pack = get_pack()
+    if pack:
+        record = pack.record(pack.random_slot())
+        return {'seed': record.seed, 'expected_count': record.expected_count}, None
+    
+    pool = get_pool()
+    return pool.get(render=False) if pool else None, None
+
+def next_challenge(difficulty=None):
+    """
+    Take the next challenge from select_challenge(), rendering it inline if
+    needed. Rendered images are left in the render cache for the image endpoint
+    """
+    captcha_data, seed = select_challenge(difficulty)
+    if captcha_data is None:
+        captcha_data = generate_captcha(seed, app.config['CAPTCHA_IMAGE_FORMATS'][0])
+    return captcha_data
+
+def difficulty_error(difficulty):
+    """Error payload for a difficulty that is not a catalog bucket, or None"""
+    if difficulty is None or difficulty in DIFFICULTIES:
+        return None
+    return {'success': False, 'message': f'Unknown difficulty, use one of: {", ".join(DIFFICULTIES)}'}
+
+def unknown_difficulty():
+    """400 response for a requested difficulty that is not a catalog bucket, or None"""
+    error = difficulty_error(request.args.get('difficulty'))
+    if error is None:
+        return None
+    response = jsonify(error)
+    response.status_code = 400
+    return response
+
+@app.route('/generate-captcha', methods=['POST'])
+def create_captcha():
+    error = unknown_difficulty()
+    if error:
+        return error
+    # Only the seed is needed here; the image is served by the image endpoint
+    captcha_data = next_challenge(difficulty=request.args.get('difficulty'))
+    return jsonify(start_challenge(captcha_data, session))
+
+def batch_count():
+    """Number of challenges a batch request asks for, within CAPTCHA_BATCH_MAX_COUNT"""
+    return min(max(request.args.get('count', 10, type=int), 1), app.config['CAPTCHA_BATCH_MAX_COUNT'])
+
+# Batches are charged one rate limit token per challenge rendered
+app.extensions['rate_limit_costs']['create_captcha_batch'] = batch_count
+
+@app.route('/generate-captcha/batch', methods=['POST'])
+def create_captcha_batch():
+    error = unknown_difficulty()
+    if error:
+        return error
+    count = batch_count()
+    difficulty = request.args.get('difficulty')
+    
+    def generate():
+        # Lines only carry the image URL; the image itself is fetched from
+        # the image endpoint, which finds it in the pack or the render cache
+        for _ in range(count):
+            captcha_data = next_challenge(difficulty=difficulty)
+            
+            # Each challenge gets its own session state, returned as a signed
+            # ticket that /verify-captcha accepts in place of the session
+            challenge_session = {}
+            item = start_challenge(captcha_data, challenge_session)
+            item['ticket'] = issue_ticket(challenge_session)
+            yield json.dumps(item) + '\n'
+    
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    # Ask proxies to pass each challenge on as soon as it is written
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def negotiate_encoder():
+    """Pick the preferred image encoder the client accepts"""
+    offered = [name for name in app.config['CAPTCHA_IMAGE_FORMATS'] if name in ENCODERS]
+    mimetypes = [ENCODERS[name]['mimetype'] for name in offered]
+    best = request.accept_mimetypes.best_match(mimetypes, default=mimetypes[0])
+    return offered[mimetypes.index(best)]
+
+def send_captcha_image(seed, encoder=None):
+    """Serve the image rendered from a seed, by default in the negotiated format"""
+    negotiated = encoder is None
+    if negotiated:
+        encoder = negotiate_encoder()
+    
+    pack = get_pack()
+    slot = pack.find(seed) if pack and pack.encoder == encoder else None
+    if slot is not None:
+        # WSGI servers need bytes, so this is the only copy of a pack image
+        image_bytes = bytes(pack.image(slot))
+        width, height = pack.width, pack.height
+    else:
+        # Images are addressed by seed, so repeat fetches come from the render cache
+        captcha_data = regenerate_captcha(seed, encoder)
+        image_bytes = captcha_data['image_bytes']
+        width, height = captcha_data['width'], captcha_data['height']
+    
+    response = send_file(
+        io.BytesIO(image_bytes),
+        mimetype=ENCODERS[encoder]['mimetype'],
+        etag=render_etag(seed, width, height, encoder),
+        max_age=app.config['CAPTCHA_IMAGE_MAX_AGE'],
+        conditional=True
+    )
+    if negotiated:
+        response.vary.add('Accept')
+    return response
+
+def extension_encoder(extension):
+    """
+    Encoder of an image URL: a .png URL always serves PNG and a .svg URL
+    SVG, while a URL without an extension is negotiated (None)
+    """
+    if extension == 'png':
+        offered = app.config['CAPTCHA_IMAGE_FORMATS']
+        return next((name for name in offered if ENCODERS.get(name, {}).get('mimetype') == 'image/png'),
+                    DEFAULT_ENCODER)
+    return extension
+
+@app.route('/captcha/<int:captcha_id>', defaults={'extension': None})
+@app.route('/captcha/<int:captcha_id>.<any(png, svg):extension>')
+def captcha_image(captcha_id, extension):
+    captcha = get_captcha(captcha_id)
+    if captcha is None:
+        abort(404)
+    return send_captcha_image(captcha['seed'], extension_encoder(extension))
+
+@app.route('/captcha/t/<token>', defaults={'extension': None})
+@app.route('/captcha/t/<token>.<any(png, svg):extension>')
+def captcha_token_image(token, extension):
+    challenge = load_token(token)
+    if challenge is None:
+        abort(404)
+    seed, _ = challenge
+    return send_captcha_image(seed, extension_encoder(extension))
+
+@app.cli.command('encoder-report')
+@click.option('--seeds', default=20, help='Number of seeds in the fixed corpus.')
+def encoder_report_command(seeds):
+    """Compare encoded size and encode time of each image encoder."""
+    corpus = [f'encoder-report-{i}' for i in range(seeds)]
+    click.echo(f"{'encoder':<12} {'mimetype':<12} {'mean bytes':>10} {'max bytes':>10} {'mean ms':>8} {'max ms':>8}")
+    for row in encoder_report(corpus):
+        click.echo(f"{row['encoder']:<12} {row['mimetype']:<12} {row['mean_bytes']:>10.0f} {row['max_bytes']:>10} "
+                   f"{row['mean_ms']:>8.2f} {row['max_ms']:>8.2f}")
+
+@app.cli.command('render-memory-report')
+def render_memory_report_command():
+    """Measure the peak RSS of one in-flight render per encoder."""
+    click.echo(f"{'encoder':<12} {'mode':<5} {'peak RSS':>10}")
+    for row in render_memory_report():
+        click.echo(f"{row['encoder']:<12} {row['mode']:<5} {row['peak_rss_kb']:>7} KB")
+
+def check_response(session, user_count, ip_address):
+    """Record a response to the session's challenge and return the verdict"""
     captcha_id = session.get('captcha_id')
+    token = session.get('captcha_token')
     
-    if not captcha_id:
-        return jsonify({'success': False, 'message': 'No CAPTCHA session found'})
+    if not captcha_id and not token:
+        return {'success': False, 'message': 'No CAPTCHA session found'}
     
-    # Get the user's IP address
-    ip_address = request.remote_addr
+    expected_count = None
+    if token:
+        challenge = load_token(token)
+        if challenge is None:
+            return {'success': False, 'message': 'CAPTCHA expired'}
+        seed, nonce = challenge
+        replay_key = 't:' + nonce
+    else:
+        replay_key = f'id:{captcha_id}'
+    
+    # A challenge can only be answered once: known replays are turned away
+    # from memory, and the database settles races between workers
+    replay_cache = get_replay_cache()
+    if replay_key in replay_cache:
+        return {'success': False, 'message': 'CAPTCHA already used'}
+    if token:
+        consumed = consume_token(nonce, app.config['CAPTCHA_TOKEN_MAX_AGE'])
+    else:
+        consumed = consume_captcha(captcha_id)
+    replay_cache.add(replay_key)
+    session.pop('captcha_id', None)
+    session.pop('captcha_token', None)
+    if not consumed:
+        return {'success': False, 'message': 'CAPTCHA already used'}
+    
+    if token:
+        # Stateless challenges get their database row with the first
+        # response; the token does not reveal the answer, so it is derived
+        # from the seed
+        expected_count = seed_expected_count(seed)
+        captcha_id = get_or_create_captcha(seed, expected_count)
     
     # Store the user's response
     store_response(captcha_id, user_count, ip_address)
     
-    # Get the captcha details
-    captcha = get_captcha(captcha_id)
-    
     # Get the most common response from other users
     most_common = get_most_common_response(captcha_id)
     
     # If there aren't enough responses yet, use the expected count
     if most_common is None:
-        most_common = captcha['expected_count']
+        if expected_count is None:
+            expected_count = get_captcha(captcha_id)['expected_count']
+        most_common = expected_count
     
     # Check if the user's count matches the most common response
     success = user_count == most_common
     
-    return jsonify({
+    return {
         'success': success,
         'message': 'CAPTCHA verification successful' if success else 'CAPTCHA verification failed',
         'expected': most_common
-    })
+    }
+
+@app.route('/verify-captcha', methods=['POST'])
+def verify_captcha():
+    user_count = request.json.get('count')
+    
+    # Get the user's IP address
+    ip_address = request.remote_addr
+    
+    # Challenges from a batch carry their session state in a ticket
+    ticket = request.json.get('ticket')
+    if ticket is not None:
+        challenge_session = load_ticket(ticket)
+        if challenge_session is None:
+            return jsonify({'success': False, 'message': 'CAPTCHA expired'})
+        return jsonify(check_response(challenge_session, user_count, ip_address))
+    
+    return jsonify(check_response(session, user_count, ip_address))
+
+@app.route('/generate-asteroids', methods=['POST'])
+def create_asteroids():
+    # The board is rebuilt from its seed when the answer comes in
+    board = Board(count=app.config['ASTEROIDS_COUNT'])
+    session['asteroids_token'] = issue_board_token(board)
+    return jsonify(board.to_dict())
+
+def check_asteroids(session, selected):
+    """Check a selection of asteroids against the session's board and return the verdict"""
+    token = session.get('asteroids_token')
+    if not token:
+        return {'success': False, 'message': 'No asteroid session found'}
+    
+    board_challenge = load_board_token(token)
+    if board_challenge is None:
+        return {'success': False, 'message': 'Asteroids expired'}
+    seed, count, nonce = board_challenge
+    
+    # Boards are answered once, like CAPTCHAs
+    replay_key = 'b:' + nonce
+    replay_cache = get_replay_cache()
+    if replay_key in replay_cache:
+        return {'success': False, 'message': 'Asteroids already used'}
+    consumed = consume_token(replay_key, app.config['CAPTCHA_TOKEN_MAX_AGE'])
+    replay_cache.add(replay_key)
+    session.pop('asteroids_token', None)
+    if not consumed:
+        return {'success': False, 'message': 'Asteroids already used'}
+    
+    if not isinstance(selected, list):
+        return {'success': False, 'message': 'Asteroid verification failed'}
+    
+    # Any conflict-free selection at least as large as the greedy reference passes
+    board = Board(seed, count=count)
+    expected = len(board.independent_set())
+    success = board.is_independent(selected) and len(selected) >= expected
+    
+    return {
+        'success': success,
+        'message': 'Asteroid verification successful' if success else 'Asteroid verification failed',
+        'expected': expected
+    }
+
+@app.route('/verify-asteroids', methods=['POST'])
+def verify_asteroids():
+    return jsonify(check_asteroids(session, request.json.get('selected')))
 
 # This allows the app to be run directly with 'python app.py'
 if __name__ == '__main__':
-    app.run(debug=True) 
\ No newline at end of file
+    app.run(debug=True) 
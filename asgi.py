@@ -0,0 +1,313 @@
+import io
+import os
+import sys
+import json
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import parse_qs
+from werkzeug.http import parse_cookie, dump_cookie
+
+import metrics
+from app import app, start_challenge, check_response, select_challenge, difficulty_error
+from captcha_tokens import load_ticket
+from ratelimit import retry_after_header
+from captcha_generator import render_captcha, render_cache
+
+# Async serving entry point, e.g. 'uvicorn asgi:application'.
+#
+# /generate-captcha and /verify-captcha are handled on the event loop: renders
+# run in a process pool and database work in a thread pool, so cheap verify
+# calls never queue behind expensive renders. Every other route is passed to
+# the Flask app in the thread pool, and its response is streamed back chunk
+# by chunk.
+
+class AsyncCaptchaServer:
+    """
+    ASGI application serving the CAPTCHA endpoints of a Flask app.
+
+    At most max_inflight renders run at once; further generate requests that
+    cannot be served from the pre-rendering pool get a 503 with Retry-After.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.render_workers = app.config['ASGI_RENDER_WORKERS']
+        self.max_inflight = app.config['ASGI_MAX_INFLIGHT_RENDERS']
+        self.retry_after = app.config['ASGI_RETRY_AFTER']
+        self.encoder = app.config['CAPTCHA_IMAGE_FORMATS'][0]
+
+        self.inflight = 0
+        self.rejected = 0
+
+        self._render_executor = None
+        self._db_executor = None
+        self._pid = None
+
+        # Keyed like the Flask endpoints so metrics line up with the WSGI app
+        self.routes = {
+            ('POST', '/generate-captcha'): ('create_captcha', self.generate),
+            ('POST', '/verify-captcha'): ('verify_captcha', self.verify),
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        body = await read_body(receive)
+        route = self.routes.get((scope['method'], scope['path']))
+        if route is None:
+            # The Flask app records its own request metrics
+            await self.wsgi(scope, body, send)
+            return
+
+        endpoint, handler = route
+        start = time.perf_counter()
+        limiter = self.app.extensions.get('rate_limiter')
+        allowed, retry_after = limiter.allow(endpoint, client_address(scope)) if limiter else (True, 0)
+        if allowed:
+            status, headers, content = await handler(scope, body)
+        else:
+            status, headers, content = json_response(
+                429, {'success': False, 'message': 'Too many requests, try again shortly'},
+                [(b'retry-after', retry_after_header(retry_after).encode())]
+            )
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+        metrics.REQUESTS.inc(endpoint=endpoint, status=str(status))
+
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': content})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._get_executors()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def generate(self, scope, body):
+        session = self.load_session(scope)
+        difficulty = parse_qs(scope['query_string'].decode('latin1')).get('difficulty', [None])[0]
+        error = difficulty_error(difficulty)
+        if error is not None:
+            return json_response(400, error)
+
+        # Pre-rendered and cached challenges cost nothing, so they bypass the
+        # render limit; a catalog seed may need a database query
+        captcha_data, seed = await self.run_db(self._select_challenge, difficulty)
+
+        if captcha_data is None:
+            if self.inflight >= self.max_inflight:
+                self.rejected += 1
+                return json_response(
+                    503, {'success': False, 'message': 'Server busy, try again shortly'},
+                    [(b'retry-after', str(self.retry_after).encode())]
+                )
+
+            render_executor, _ = self._get_executors()
+            self.inflight += 1
+            try:
+                captcha_data = await asyncio.get_running_loop().run_in_executor(
+                    render_executor, render_captcha, seed, self.encoder
+                )
+            finally:
+                self.inflight -= 1
+            render_cache.put(captcha_data)
+
+        payload = await self.run_db(self._start_challenge, scope, captcha_data, session)
+        return json_response(200, payload, self.session_headers(session))
+
+    async def verify(self, scope, body):
+        session = self.load_session(scope)
+        try:
+            data = json.loads(body)
+            user_count, ticket = data.get('count'), data.get('ticket')
+        except (ValueError, AttributeError):
+            return json_response(400, {'success': False, 'message': 'Invalid JSON body'})
+
+        payload = await self.run_db(self._check_response, session, ticket, user_count, client_address(scope))
+        if ticket is not None:
+            return json_response(200, payload)
+        # The verified challenge was taken out of the session, as in the Flask view
+        return json_response(200, payload, self.session_headers(session))
+
+    async def wsgi(self, scope, body, send):
+        # The WSGI response is produced by one pool thread (streamed responses
+        # keep their Flask context in it) and handed over chunk by chunk; the
+        # small queue stops a slow client from buffering the whole response
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue(maxsize=2)
+
+        def put(message):
+            asyncio.run_coroutine_threadsafe(chunks.put(message), loop).result()
+
+        producer = asyncio.ensure_future(self.run_db(run_wsgi, self.app, scope, body, put))
+        try:
+            while True:
+                message = await chunks.get()
+                if message is None:
+                    break
+                await send(message)
+        finally:
+            # Keep draining if sending failed, so the producer thread can finish
+            while not producer.done():
+                getter = asyncio.ensure_future(chunks.get())
+                await asyncio.wait([producer, getter], return_when=asyncio.FIRST_COMPLETED)
+                getter.cancel()
+            await producer
+
+    async def run_db(self, func, *args):
+        _, db_executor = self._get_executors()
+        return await asyncio.get_running_loop().run_in_executor(db_executor, func, *args)
+
+    def load_session(self, scope):
+        """Read the Flask session cookie into a plain dict"""
+        interface = self.app.session_interface
+        serializer = interface.get_signing_serializer(self.app)
+        cookie = parse_cookie(header(scope, b'cookie')).get(interface.get_cookie_name(self.app))
+        if serializer is None or not cookie:
+            return {}
+        try:
+            max_age = int(self.app.permanent_session_lifetime.total_seconds())
+            return serializer.loads(cookie, max_age=max_age)
+        except Exception:
+            return {}
+
+    def session_headers(self, session):
+        """Set-Cookie header storing the session the way Flask would"""
+        interface = self.app.session_interface
+        cookie = dump_cookie(
+            interface.get_cookie_name(self.app),
+            interface.get_signing_serializer(self.app).dumps(dict(session)),
+            domain=interface.get_cookie_domain(self.app),
+            path=interface.get_cookie_path(self.app),
+            secure=interface.get_cookie_secure(self.app),
+            httponly=interface.get_cookie_httponly(self.app),
+            samesite=interface.get_cookie_samesite(self.app),
+        )
+        return [(b'set-cookie', cookie.encode('latin1'))]
+
+    def close(self):
+        """Shut down the render and database executors"""
+        render_executor, self._render_executor = self._render_executor, None
+        db_executor, self._db_executor = self._db_executor, None
+        if self._pid == os.getpid():
+            if render_executor is not None:
+                render_executor.shutdown(wait=False, cancel_futures=True)
+            if db_executor is not None:
+                db_executor.shutdown(wait=False)
+
+    def _get_executors(self):
+        # Executors inherited across fork() are unusable, so each server
+        # process starts its own on first use
+        if self._render_executor is None or self._pid != os.getpid():
+            self._render_executor = ProcessPoolExecutor(max_workers=self.render_workers)
+            self._db_executor = ThreadPoolExecutor(
+                max_workers=self.app.config['ASGI_DB_THREADS'], thread_name_prefix='captcha-db'
+            )
+            self._pid = os.getpid()
+        return self._render_executor, self._db_executor
+
+    def _select_challenge(self, difficulty):
+        with self.app.app_context():
+            return select_challenge(difficulty)
+
+    def _start_challenge(self, scope, captcha_data, session):
+        # url_for needs a request context, but nothing is read from it
+        with self.app.test_request_context(base_url='http://localhost' + scope.get('root_path', '')):
+            return start_challenge(captcha_data, session)
+
+    def _check_response(self, session, ticket, user_count, ip_address):
+        with self.app.app_context():
+            # Challenges from a batch carry their session state in a ticket
+            if ticket is not None:
+                session = load_ticket(ticket)
+                if session is None:
+                    return {'success': False, 'message': 'CAPTCHA expired'}
+            return check_response(session, user_count, ip_address)
+
+async def read_body(receive):
+    """Collect the full request body"""
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+def header(scope, name):
+    """Return a request header as a string, joining repeated headers"""
+    return ', '.join(value.decode('latin1') for key, value in scope['headers'] if key == name)
+
+def client_address(scope):
+    # Mirror ProxyFix in app.py, which trusts one X-Forwarded-For hop
+    forwarded = header(scope, b'x-forwarded-for')
+    if forwarded:
+        return forwarded.split(',')[-1].strip()
+    client = scope.get('client')
+    return client[0] if client else None
+
+def json_response(status, payload, headers=()):
+    return status, [(b'content-type', b'application/json'), *headers], json.dumps(payload).encode()
+
+def run_wsgi(wsgi_app, scope, body, put):
+    """
+    Run a WSGI app for an ASGI request, passing each ASGI response message to
+    put() as it is produced and None once the response is complete
+    """
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for key, value in scope['headers']:
+        name = key.decode('latin1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin1')
+        environ[name] = environ[name] + ',' + value if name in environ else value
+
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(k.lower().encode('latin1'), v.encode('latin1')) for k, v in headers]
+
+    started = False
+    result = wsgi_app(environ, start_response)
+    try:
+        for chunk in result:
+            # start_response may be deferred until the first chunk is produced
+            if not started:
+                put({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+                started = True
+            if chunk:
+                put({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+        if not started and 'status' in response:
+            put({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+        put({'type': 'http.response.body', 'body': b''})
+        put(None)
+
+application = AsyncCaptchaServer(app)
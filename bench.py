@@ -0,0 +1,236 @@
+import gc
+import sys
+import ctypes
+import ctypes.util
+import json
+import time
+import platform
+import tracemalloc
+import click
+import PIL
+
+from captcha_generator import (GeometricCaptcha, GENERATOR_VERSION, BACKENDS, ENCODERS, DEFAULT_ENCODER,
+                               encoder_mode, rss_kb, reset_peak_rss)
+
+# Micro-benchmarks for GeometricCaptcha.generate(), stage by stage.
+#
+#   python bench.py run --seeds 50 --json results.json
+#   python bench.py compare baseline.json results.json --threshold 0.10
+
+# Generator methods timed as stages, in the order generate() calls them
+STAGES = (
+    ('largest_rectangle', 'create_largest_rectangle'),
+    ('kanizsa_rectangle', 'create_kanizsa_rectangle'),
+    ('kanizsa_triangle', 'create_kanizsa_triangle'),
+    ('grid_pacmen', 'create_grid_pacmen'),
+    ('rasterize_pacmen', 'rasterize_pacmen'),
+    ('grid_coordinates', 'add_grid_coordinates'),
+    ('encode', 'get_image_bytes'),
+)
+
+def trim_heap():
+    """
+    Return free heap memory to the OS where glibc allows it, so that a
+    following render's buffers show up as RSS growth instead of reusing
+    pages that are already resident
+    """
+    gc.collect()
+    try:
+        ctypes.CDLL(ctypes.util.find_library('c')).malloc_trim(0)
+    except (OSError, AttributeError, TypeError):
+        pass
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+def summarize(samples):
+    """Latency distribution of a list of durations in seconds, in milliseconds"""
+    return {
+        'n': len(samples),
+        'mean_ms': sum(samples) / len(samples) * 1000,
+        'p50_ms': percentile(samples, 0.50) * 1000,
+        'p90_ms': percentile(samples, 0.90) * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+        'max_ms': max(samples) * 1000,
+    }
+
+def instrument(captcha, timings):
+    """Wrap the stage methods of one generator instance to record their durations"""
+    for stage, method in STAGES:
+        original = getattr(captcha, method)
+
+        def timed(*args, _stage=stage, _original=original, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _original(*args, **kwargs)
+            finally:
+                timings[_stage] = timings.get(_stage, 0.0) + time.perf_counter() - start
+
+        setattr(captcha, method, timed)
+
+def render(seed, backend, encoder, timings=None):
+    captcha = GeometricCaptcha(seed=seed, backend=backend, mode=encoder_mode(encoder))
+    if timings is not None:
+        instrument(captcha, timings)
+    return captcha.generate(encoder)
+
+def run_benchmark(seeds, repeat=3, backend='pillow', encoder=DEFAULT_ENCODER, warmup=2):
+    """
+    Render every seed of the corpus repeat times, returning per-stage and
+    end-to-end latency distributions, memory and output size statistics.
+    Peak RSS includes Pillow's pixel buffers; it is None where the peak
+    cannot be reset (outside Linux)
+    """
+    for i in range(warmup):
+        render(f'bench-warmup-{i}', backend, encoder)
+
+    stages = {stage: [] for stage, _ in STAGES}
+    totals = []
+    sizes = []
+
+    gc.collect()
+    for _ in range(repeat):
+        for seed in seeds:
+            timings = {}
+            start = time.perf_counter()
+            captcha_data = render(seed, backend, encoder, timings)
+            totals.append(time.perf_counter() - start)
+            sizes.append(len(captcha_data['image_bytes']))
+            for stage, duration in timings.items():
+                stages[stage].append(duration)
+
+    # Memory is measured in separate passes so it doesn't skew timings. The
+    # growth of the resident set covers everything a render touches,
+    # including image buffers allocated inside Pillow
+    try:
+        rss_peaks = []
+        for seed in seeds:
+            trim_heap()
+            reset_peak_rss()
+            before = rss_kb('VmRSS')
+            render(seed, backend, encoder)
+            rss_peaks.append(rss_kb('VmHWM') - before)
+    except OSError:
+        rss_peaks = None
+
+    # tracemalloc only sees allocations made through Python's allocator
+    peaks = []
+    retained = []
+    tracemalloc.start()
+    for seed in seeds:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        render(seed, backend, encoder)
+        current, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - before)
+        retained.append(current - before)
+    tracemalloc.stop()
+
+    return {
+        'meta': {
+            'generator_version': GENERATOR_VERSION,
+            'backend': backend,
+            'encoder': encoder,
+            'seeds': len(seeds),
+            'repeat': repeat,
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'platform': platform.platform(),
+        },
+        'stages': {stage: summarize(samples) for stage, samples in stages.items() if samples},
+        'total': summarize(totals),
+        'rss': {
+            'peak_kb_mean': sum(rss_peaks) / len(rss_peaks),
+            'peak_kb_max': max(rss_peaks),
+        } if rss_peaks else None,
+        'python_allocations': {
+            'peak_kb_mean': sum(peaks) / len(peaks) / 1024,
+            'peak_kb_max': max(peaks) / 1024,
+            'retained_kb_mean': sum(retained) / len(retained) / 1024,
+        },
+        'output_bytes': {
+            'mean': sum(sizes) / len(sizes),
+            'max': max(sizes),
+        },
+    }
+
+def compare_results(baseline, current, metric='p50_ms', threshold=0.10):
+    """
+    Compare a latency metric of two benchmark results, returning rows of
+    (name, baseline, current, relative change, regressed)
+    """
+    pairs = [(name, baseline['stages'][name], row) for name, row in current['stages'].items()
+             if name in baseline['stages']]
+    pairs.append(('total', baseline['total'], current['total']))
+
+    rows = []
+    for name, before, after in pairs:
+        old, new = before[metric], after[metric]
+        change = (new - old) / old if old else 0.0
+        rows.append((name, old, new, change, change > threshold))
+
+    # Output size and memory regress the same way as latency; sections
+    # missing from either result are skipped
+    for name, section, key in (('output_bytes', 'output_bytes', 'mean'),
+                               ('rss_peak_kb', 'rss', 'peak_kb_mean'),
+                               ('py_alloc_peak_kb', 'python_allocations', 'peak_kb_mean')):
+        if not baseline.get(section) or not current.get(section):
+            continue
+        old, new = baseline[section][key], current[section][key]
+        change = (new - old) / old if old else 0.0
+        rows.append((name, old, new, change, change > threshold))
+    return rows
+
+@click.group()
+def cli():
+    """CAPTCHA generator benchmarks."""
+
+@cli.command('run')
+@click.option('--seeds', default=30, help='Number of seeds in the fixed corpus.')
+@click.option('--repeat', default=3, help='Times each seed is rendered.')
+@click.option('--backend', type=click.Choice(BACKENDS), default='pillow')
+@click.option('--encoder', type=click.Choice(sorted(ENCODERS)), default=DEFAULT_ENCODER)
+@click.option('--json', 'json_path', type=click.Path(dir_okay=False), help='Write the results to this file.')
+def run_command(seeds, repeat, backend, encoder, json_path):
+    """Benchmark generate() over a fixed seed corpus."""
+    corpus = [f'bench-{i}' for i in range(seeds)]
+    results = run_benchmark(corpus, repeat, backend, encoder)
+
+    click.echo(f"{'stage':<18} {'n':>5} {'mean ms':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for name, row in list(results['stages'].items()) + [('total', results['total'])]:
+        click.echo(f"{name:<18} {row['n']:>5} {row['mean_ms']:>8.2f} {row['p50_ms']:>8.2f} "
+                   f"{row['p90_ms']:>8.2f} {row['p99_ms']:>8.2f} {row['max_ms']:>8.2f}")
+    if results['rss']:
+        click.echo(f"peak RSS growth {results['rss']['peak_kb_mean']:.0f} KB mean, "
+                   f"{results['rss']['peak_kb_max']:.0f} KB max")
+    else:
+        click.echo('peak RSS growth not available on this platform')
+    click.echo(f"peak Python allocations {results['python_allocations']['peak_kb_mean']:.0f} KB mean, "
+               f"{results['python_allocations']['peak_kb_max']:.0f} KB max")
+    click.echo(f"output size {results['output_bytes']['mean']:.0f} bytes mean, "
+               f"{results['output_bytes']['max']} bytes max")
+
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+@cli.command('compare')
+@click.argument('baseline', type=click.File())
+@click.argument('current', type=click.File())
+@click.option('--metric', type=click.Choice(['mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms']), default='p50_ms')
+@click.option('--threshold', default=0.10, help='Relative slowdown counted as a regression.')
+def compare_command(baseline, current, metric, threshold):
+    """Compare two result files, exiting non-zero on regressions."""
+    rows = compare_results(json.load(baseline), json.load(current), metric, threshold)
+
+    click.echo(f"{'stage':<18} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, old, new, change, regressed in rows:
+        click.echo(f"{name:<18} {old:>10.2f} {new:>10.2f} {change:>+8.1%}{'  REGRESSION' if regressed else ''}")
+
+    if any(regressed for *_, regressed in rows):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    cli()
@@ -3,25 +3,392 @@ import math
 import io
 import base64
 import hashlib
+import sys
+import threading
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+from functools import lru_cache
 
 try:
-    from PIL import Image, ImageDraw, ImageFont
-except ImportError:
-    print("ERROR: Pillow is not installed. Please install it using 'pip install pillow'")
-    # Provide mock implementations or exit gracefully
-    import sys
-    sys.exit(1)
+    from PIL import Image, ImageDraw, ImageFont, features
+except ImportError as e:
+    raise ImportError("Pillow is not installed. Please install it using 'pip install pillow'") from e
+
+import numpy as np
+
+import metrics
+from pacman_raster import rasterize_pacmen
+
+# Raster backends draw pacmen with Pillow or in one NumPy batch; the svg
+# backend only builds the scene and writes it out as vectors. Pillow is the
+# default: with a challenge's ~75 pacmen its pieslice calls are about 4x
+# cheaper than the NumPy pass (see bench.py)
+BACKENDS = ('pillow', 'numpy', 'svg')
+
+# Background, pacman and label colours for each supported image mode. In
+# 1-bit mode the grey labels cannot be represented and are drawn black.
+MODE_COLORS = {
+    'RGB': {'background': (255, 255, 255), 'ink': (0, 0, 0), 'label': (150, 150, 150)},
+    'L': {'background': 255, 'ink': 0, 'label': 150},
+    '1': {'background': 1, 'ink': 0, 'label': 0},
+}
+
+# Bumped whenever the same seed would render a different image
+GENERATOR_VERSION = 3
+
+# Kanizsa shapes are placed by evaluating this many random candidates at
+# once, for at most this many batches
+PLACEMENT_BATCH = 64
+PLACEMENT_BATCHES = 4
+
+# Placement rotations are whole degrees, so their sines and cosines are looked
+# up (negative degrees index from the end)
+COS_DEGREES = np.cos(np.radians(np.arange(360)))
+SIN_DEGREES = np.sin(np.radians(np.arange(360)))
+
+# Rectangle corners as fractions of its width and height, clockwise from the
+# top-left, and triangle corner angles as offsets plus multiples of the
+# angle variation
+RECTANGLE_CORNERS = np.array([[0, 1, 1, 0], [0, 0, 1, 1]])
+TRIANGLE_ANGLES = np.array([[0, 120, 240], [0, 1, -1]])
+
+# A filler pacman needs its own cell and these neighbours to be free
+PLUS_NEIGHBOURHOOD = [(0, 0), (0, 1), (0, -1), (1, 0), (-1, 0)]
+
+# Output encoders: name -> image format, mimetype, image mode and save options.
+# Images are rendered directly in the encoder's mode, so no conversion is needed
+ENCODERS = {}
+
+def register_encoder(name, mimetype, format, mode=None, **options):
+    """Register an output encoder under a name"""
+    ENCODERS[name] = {
+        'mimetype': mimetype,
+        'format': format,
+        'mode': mode,
+        'options': options
+    }
+
+# 24-bit PNG, as originally served
+register_encoder('png', 'image/png', 'PNG')
+# The picture is only black, white and grey labels, so 8-bit greyscale loses
+# nothing and is both smaller and cheaper to encode
+register_encoder('png-gray', 'image/png', 'PNG', mode='L', compress_level=6)
+# 1-bit PNG for the lowest memory and size, with black labels
+register_encoder('png-1bit', 'image/png', 'PNG', mode='1', compress_level=6)
+if features.check('webp'):
+    register_encoder('webp', 'image/webp', 'WEBP', mode='L', lossless=True, method=4, quality=0)
+
+# Vector output written straight from the scene; no raster is involved
+register_encoder('svg', 'image/svg+xml', 'SVG')
+
+# The cheapest lossless raster that keeps the anti-aliased grey labels:
+# encoder_report() puts it at about 2/3 of the 24-bit PNG size and 2.5x
+# faster to encode. png-1bit and svg are cheaper still, but png-1bit draws
+# the labels black and svg hands out the exact geometry
+DEFAULT_ENCODER = 'png-gray'
+
+def is_vector(encoder):
+    """Whether an encoder writes the scene as vectors instead of encoding a raster"""
+    return ENCODERS[encoder]['format'] == 'SVG'
+
+def encode_image(image, encoder=DEFAULT_ENCODER):
+    """Encode an image with a registered raster encoder"""
+    if is_vector(encoder):
+        raise ValueError(f"{encoder!r} is a vector encoder; use Scene.to_svg()")
+    spec = ENCODERS[encoder]
+    if spec['mode'] is not None and image.mode != spec['mode']:
+        image = image.convert(spec['mode'])
+    buffer = io.BytesIO()
+    image.save(buffer, format=spec['format'], **spec['options'])
+    return buffer.getvalue()
+
+@lru_cache(maxsize=None)
+def load_font(size=10):
+    """Load the label font once per process"""
+    # Try to use a default font, or fallback to default
+    try:
+        return ImageFont.truetype("Arial", size)
+    except IOError:
+        return ImageFont.load_default()
+
+def encoder_mode(encoder):
+    """Image mode to render in for an encoder"""
+    return ENCODERS[encoder]['mode'] or 'RGB'
+
+@lru_cache(maxsize=16)
+def blank_canvas(width, height, mode='RGB'):
+    """Shared white canvas for a geometry; copy it, never draw on it"""
+    return Image.new(mode, (width, height), color=MODE_COLORS[mode]['background'])
+
+def label_positions(width, height, cell_size, rows, cols):
+    """Grid coordinate labels of a geometry, as (x, y, text, anchor) tuples"""
+    labels = []
+    
+    # Column numbers (X-axis), at the top and at the bottom
+    for col in range(cols):
+        x = col * cell_size + cell_size // 2
+        labels.append((x, 5, str(col), "mt"))
+        labels.append((x, height - 5, str(col), "mb"))
+    
+    # Row numbers (Y-axis), on the left and on the right
+    for row in range(rows):
+        y = row * cell_size + cell_size // 2
+        labels.append((5, y, str(row), "lm"))
+        labels.append((width - 5, y, str(row), "rm"))
+    
+    return labels
+
+@lru_cache(maxsize=16)
+def coordinate_labels(width, height, cell_size, rows, cols, scale=1):
+    """
+    Pre-rendered grid coordinate labels for a geometry, as an 'L' coverage
+    mask to paste the label colour through
+    """
+    labels = Image.new('L', (round(width * scale), round(height * scale)), 0)
+    draw = ImageDraw.Draw(labels)
+    font = load_font(round(10 * scale))
+    
+    for x, y, text, anchor in label_positions(width, height, cell_size, rows, cols):
+        draw.text((x * scale, y * scale), text, fill=255, font=font, anchor=anchor)
+    
+    return labels
+
+@lru_cache(maxsize=16)
+def coordinate_label_mask(width, height, cell_size, rows, cols, mode='RGB', scale=1):
+    """Label mask for an image mode; 1-bit images need a hard-edged mask"""
+    labels = coordinate_labels(width, height, cell_size, rows, cols, scale)
+    if mode == '1':
+        return labels.point(lambda value: 255 if value >= 128 else 0)
+    return labels
+
+class Scene:
+    """
+    Vector description of a challenge: the pacman primitives, stored flat as
+    doubles (x, y, radius, start angle, end angle), and the grid geometry
+    that defines the coordinate labels. It can be rendered to a raster at any
+    scale or written out as SVG.
+    """
+    __slots__ = ('width', 'height', 'cell_size', 'rows', 'cols', 'pacmen')
+    
+    def __init__(self, width, height, cell_size, rows, cols):
+        self.width = width
+        self.height = height
+        self.cell_size = cell_size
+        self.rows = rows
+        self.cols = cols
+        self.pacmen = array('d')
+    
+    def add_pacman(self, x, y, radius, start, end):
+        self.pacmen.extend((x, y, radius, start, end))
+    
+    def primitives(self):
+        """Pacman primitives as (x, y, radius, start, end) tuples"""
+        values = self.pacmen
+        return [tuple(values[i:i + 5]) for i in range(0, len(values), 5)]
+    
+    def labels(self):
+        return label_positions(self.width, self.height, self.cell_size, self.rows, self.cols)
+    
+    def render(self, mode='RGB', backend='pillow', scale=1):
+        """Rasterize the scene; at scale 1 this matches the generated image"""
+        colors = MODE_COLORS[mode]
+        width, height = round(self.width * scale), round(self.height * scale)
+        image = blank_canvas(width, height, mode).copy()
+        primitives = [(x * scale, y * scale, radius * scale, start, end)
+                      for x, y, radius, start, end in self.primitives()]
+        
+        if backend == 'numpy':
+            image.paste(colors['ink'], (0, 0), Image.fromarray(rasterize_pacmen(width, height, primitives)))
+        elif backend == 'pillow':
+            draw = ImageDraw.Draw(image)
+            for x, y, radius, start, end in primitives:
+                draw.pieslice([x - radius, y - radius, x + radius, y + radius], start, end,
+                              fill=colors['ink'], outline=None)
+        else:
+            raise ValueError(f"Not a raster backend: {backend!r}")
+        
+        labels = coordinate_label_mask(self.width, self.height, self.cell_size, self.rows, self.cols, mode, scale)
+        image.paste(colors['label'], (0, 0), labels)
+        return image
+    
+    def to_svg(self):
+        """Write the scene as a compact SVG document"""
+        # All pacmen share one path. Angles follow Pillow: degrees clockwise
+        # from 3 o'clock, which is also SVG's positive direction
+        path = []
+        for x, y, r, start, end in self.primitives():
+            sweep = (end - start) % 360 if end - start < 360 else 360
+            if sweep == 0:
+                continue
+            if sweep == 360:
+                path.append(f'M{x - r:.1f} {y:.1f}a{r:.1f} {r:.1f} 0 1 0 {2 * r:.1f} 0a{r:.1f} {r:.1f} 0 1 0 {-2 * r:.1f} 0z')
+                continue
+            # Relative commands keep the numbers short
+            dx1, dy1 = r * math.cos(math.radians(start)), r * math.sin(math.radians(start))
+            dx2 = r * math.cos(math.radians(start + sweep)) - dx1
+            dy2 = r * math.sin(math.radians(start + sweep)) - dy1
+            path.append(f'M{x:.1f} {y:.1f}l{dx1:.1f} {dy1:.1f}a{r:.1f} {r:.1f} 0 {int(sweep > 180)} 1 {dx2:.1f} {dy2:.1f}z')
+        
+        # SVG equivalents of the Pillow text anchors used for the labels
+        anchors = {
+            'mt': ('middle', 'hanging'),
+            'mb': ('middle', 'text-after-edge'),
+            'lm': ('start', 'central'),
+            'rm': ('end', 'central'),
+        }
+        groups = {anchor: [] for anchor in anchors}
+        for x, y, text, anchor in self.labels():
+            groups[anchor].append(f'<text x="{x}" y="{y}">{text}</text>')
+        texts = [f'<g text-anchor="{anchors[anchor][0]}" dominant-baseline="{anchors[anchor][1]}">{"".join(items)}</g>'
+                 for anchor, items in groups.items() if items]
+        
+        return (
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{self.width}" height="{self.height}" '
+            f'viewBox="0 0 {self.width} {self.height}">'
+            f'<rect width="100%" height="100%" fill="#fff"/>'
+            f'<path d="{"".join(path)}"/>'
+            f'<g fill="#969696" font-family="sans-serif" font-size="10">{"".join(texts)}</g>'
+            f'</svg>'
+        )
+
+class EmergentShape:
+    """
+    Compact record of an emergent shape. Corners are stored flat as doubles
+    and corner grid positions flat as small ints
+    """
+    __slots__ = ('type', 'corners', 'corner_grid_positions', 'rotation',
+                 'width', 'height', 'size', 'is_largest')
+    
+    def __init__(self, type, corners, corner_grid_positions=(), rotation=0,
+                 width=0, height=0, size=0, is_largest=False):
+        self.type = type
+        self.corners = array('d', [coord for corner in corners for coord in corner])
+        self.corner_grid_positions = array('b', [coord for pos in corner_grid_positions for coord in pos])
+        self.rotation = rotation
+        self.width = width
+        self.height = height
+        self.size = size
+        self.is_largest = is_largest
+
+class RenderedCaptcha:
+    """
+    Compact form of a rendered challenge for long-lived containers such as
+    the render cache and the pre-rendering pool
+    """
+    __slots__ = ('seed', 'expected_count', 'expected_answer', 'image_bytes',
+                 'image_format', 'width', 'height', 'challenge_type')
+    
+    def __init__(self, seed, expected_count, expected_answer, image_bytes,
+                 image_format, width, height, challenge_type):
+        self.seed = seed
+        self.expected_count = expected_count
+        self.expected_answer = array('b', expected_answer)
+        self.image_bytes = image_bytes
+        self.image_format = image_format
+        self.width = width
+        self.height = height
+        self.challenge_type = challenge_type
+    
+    @classmethod
+    def from_dict(cls, captcha_data):
+        return cls(**{name: captcha_data[name] for name in cls.__slots__})
+    
+    def to_dict(self):
+        captcha_data = {name: getattr(self, name) for name in self.__slots__}
+        captcha_data['expected_answer'] = list(self.expected_answer)
+        return captcha_data
+
+class OccupancyGrid:
+    """
+    Bitmap of taken grid cells.
+    
+    It can also maintain the list of cells that are still eligible for a
+    filler pacman (the cell and its plus-shaped neighbourhood are free), so
+    placement samples only from usable cells instead of rejection sampling.
+    """
+    def __init__(self, cols, rows):
+        self.cols = cols
+        self.rows = rows
+        self.taken = bytearray(cols * rows)
+        self._eligible = None  # cell indices, in sampling order
+        self._slots = None  # cell index -> position in _eligible, or -1
+    
+    def __contains__(self, pos):
+        grid_x, grid_y = pos
+        if 0 <= grid_x < self.cols and 0 <= grid_y < self.rows:
+            return self.taken[grid_y * self.cols + grid_x] == 1
+        return False
+    
+    def add(self, pos):
+        """Mark a grid position as taken"""
+        grid_x, grid_y = pos
+        if not (0 <= grid_x < self.cols and 0 <= grid_y < self.rows):
+            return
+        self.taken[grid_y * self.cols + grid_x] = 1
+        
+        # Neither this cell nor its neighbours can host a filler pacman now
+        if self._eligible is not None:
+            for dx, dy in PLUS_NEIGHBOURHOOD:
+                check_x, check_y = grid_x + dx, grid_y + dy
+                if 0 <= check_x < self.cols and 0 <= check_y < self.rows:
+                    self._discard(check_y * self.cols + check_x)
+    
+    def track_free_cells(self, min_x, max_x, min_y, max_y):
+        """Start tracking eligible cells within an inclusive range of the grid"""
+        self._eligible = []
+        self._slots = [-1] * (self.cols * self.rows)
+        for grid_y in range(min_y, max_y + 1):
+            for grid_x in range(min_x, max_x + 1):
+                if not any((grid_x + dx, grid_y + dy) in self for dx, dy in PLUS_NEIGHBOURHOOD):
+                    index = grid_y * self.cols + grid_x
+                    self._slots[index] = len(self._eligible)
+                    self._eligible.append(index)
+    
+    def sample_free_cell(self, rng):
+        """Pick a uniformly random eligible cell, or None if none are left"""
+        if not self._eligible:
+            return None
+        index = self._eligible[rng.randrange(len(self._eligible))]
+        return index % self.cols, index // self.cols
+    
+    def _discard(self, index):
+        # Swap-remove keeps removal O(1)
+        slot = self._slots[index]
+        if slot < 0:
+            return
+        last = self._eligible.pop()
+        if last != index:
+            self._eligible[slot] = last
+            self._slots[last] = slot
+        self._slots[index] = -1
 
 class GeometricCaptcha:
-    def __init__(self, width=720, height=720, seed=None):
+    def __init__(self, width=720, height=720, seed=None, backend='pillow', mode='RGB'):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown rendering backend: {backend!r}")
+        if mode not in MODE_COLORS:
+            raise ValueError(f"Unsupported image mode: {mode!r}")
+        
         self.width = width
         self.height = height
+        self.backend = backend
+        self.mode = mode
+        self.colors = MODE_COLORS[mode]
         self.seed = seed if seed else hashlib.md5(str(random.random()).encode()).hexdigest()
         self.rng = random.Random(self.seed)
+        # Vectorized placement draws from a NumPy generator seeded the same way
+        self.np_rng = np.random.default_rng(self.rng.getrandbits(64))
         
-        # Create a white background
-        self.image = Image.new('RGB', (width, height), color=(255, 255, 255))
-        self.draw = ImageDraw.Draw(self.image)
+        # Start from a copy of the cached white background; the svg backend
+        # never needs a raster
+        if backend == 'svg':
+            self.image = None
+            self.draw = None
+        else:
+            self.image = blank_canvas(width, height, mode).copy()
+            self.draw = ImageDraw.Draw(self.image)
         
         # Grid parameters - more organized but still with some randomness
         self.cell_size = 45  # Keep cell size the same
@@ -32,36 +399,25 @@ class GeometricCaptcha:
         # Pacman parameters
         self.pacman_radius = self.cell_size * 0.33  # Smaller pacman shapes
         
+        # Vector description of everything placed; pacmen are rasterized
+        # from it in one batch at the end when using the numpy backend
+        self.scene = Scene(width, height, self.cell_size, self.rows, self.cols)
+        
         # Emergent patterns
         self.emergent_shapes = []
         self.expected_count = 0
         
-        # Some "taken" positions to avoid overlap
-        self.taken_positions = set()
-        
-        # Try to use a default font, or fallback to default
-        try:
-            self.font = ImageFont.truetype("Arial", 10)
-        except IOError:
-            self.font = ImageFont.load_default()
+        # Taken grid cells, to avoid overlap
+        self.occupancy = OccupancyGrid(self.cols, self.rows)
     
     def add_grid_coordinates(self):
         """Add grid coordinate numbers along the X and Y axes"""
-        # Draw column numbers (X-axis)
-        for col in range(self.cols):
-            x = col * self.cell_size + self.cell_size // 2
-            # At the top
-            self.draw.text((x, 5), str(col), fill=(150, 150, 150), font=self.font, anchor="mt")
-            # At the bottom
-            self.draw.text((x, self.height - 5), str(col), fill=(150, 150, 150), font=self.font, anchor="mb")
-        
-        # Draw row numbers (Y-axis)
-        for row in range(self.rows):
-            y = row * self.cell_size + self.cell_size // 2
-            # On the left
-            self.draw.text((5, y), str(row), fill=(150, 150, 150), font=self.font, anchor="lm")
-            # On the right
-            self.draw.text((self.width - 5, y), str(row), fill=(150, 150, 150), font=self.font, anchor="rm")
+        # The labels only depend on the geometry, so they are rendered once
+        # per process and composited in a single paste
+        if self.image is None:
+            return  # Labels are part of the scene; the svg backend has no raster
+        labels = coordinate_label_mask(self.width, self.height, self.cell_size, self.rows, self.cols, self.mode)
+        self.image.paste(self.colors['label'], (0, 0), labels)
     
     def create_pacman(self, x, y, angle1, angle2, radius=None):
         """
@@ -75,14 +431,21 @@ class GeometricCaptcha:
             radius_variation = self.rng.uniform(0.95, 1.05)
             radius *= radius_variation
         
-        # Draw the pacman
-        bbox = [x - radius, y - radius, x + radius, y + radius]
-        self.draw.pieslice(bbox, angle1, angle2, fill=(0, 0, 0), outline=None)
+        # Draw the pacman now, or defer it to the batch rasterizer
+        self.scene.add_pacman(x, y, radius, angle1, angle2)
+        if self.backend == 'pillow':
+            bbox = [x - radius, y - radius, x + radius, y + radius]
+            self.draw.pieslice(bbox, angle1, angle2, fill=self.colors['ink'], outline=None)
         
         # Mark this position as taken
         grid_x = int(x // self.cell_size)
         grid_y = int(y // self.cell_size)
-        self.taken_positions.add((grid_x, grid_y))
+        self.occupancy.add((grid_x, grid_y))
+    
+    def rasterize_pacmen(self):
+        """Draw all deferred pacmen in one vectorized pass (numpy backend)"""
+        mask = rasterize_pacmen(self.width, self.height, self.scene.primitives())
+        self.image.paste(self.colors['ink'], (0, 0), Image.fromarray(mask))
     
     def create_grid_pacmen(self):
         """Create a more random distribution of pacman shapes while preventing overlaps"""
@@ -90,310 +453,199 @@ class GeometricCaptcha:
         total_pacmen = int(self.rows * self.cols * 0.995)  # Increased from 0.98 to 0.995
         pacmen_created = 0
         
-        # Try to place pacmen until we reach the target or hit max attempts
-        max_attempts = total_pacmen * 4  # Increased attempts to ensure higher density
-        attempts = 0
-        
-        # Calculate safe area to ensure complete pacmans
-        safe_padding = self.cell_size  # One full cell size padding
-        safe_area_start_x = safe_padding
-        safe_area_end_x = self.width - safe_padding
-        safe_area_start_y = safe_padding
-        safe_area_end_y = self.height - safe_padding
-        
-        while pacmen_created < total_pacmen and attempts < max_attempts:
-            # Generate random position within the safe area
-            x = self.rng.randint(safe_area_start_x, safe_area_end_x)
-            y = self.rng.randint(safe_area_start_y, safe_area_end_y)
-            
-            # Get the grid position for overlap checking
-            grid_x = int(x // self.cell_size)
-            grid_y = int(y // self.cell_size)
+        # Only cells at least one cell away from the border give complete
+        # pacmans; sample among those whose plus-shaped neighbourhood is free
+        self.occupancy.track_free_cells(1, self.cols - 2, 1, self.rows - 2)
+        
+        while pacmen_created < total_pacmen:
+            cell = self.occupancy.sample_free_cell(self.rng)
+            if cell is None:
+                break
             
-            # Skip if this position would result in a partial pacman
-            if (grid_x < 1 or grid_x >= self.cols - 1 or 
-                grid_y < 1 or grid_y >= self.rows - 1):
-                attempts += 1
-                continue
+            # Random position within the chosen cell
+            grid_x, grid_y = cell
+            x = grid_x * self.cell_size + self.rng.randrange(self.cell_size)
+            y = grid_y * self.cell_size + self.rng.randrange(self.cell_size)
             
-            # Check only immediate adjacent cells for overlaps (reduced from 3x3 to plus shape)
-            overlap = False
-            for dx, dy in [(0,0), (0,1), (0,-1), (1,0), (-1,0)]:  # Plus shape check
-                check_x = grid_x + dx
-                check_y = grid_y + dy
-                if (check_x, check_y) in self.taken_positions:
-                    overlap = True
-                    break
+            # Use strict 90-degree increments with minimal variation
+            base_angle = self.rng.choice([0, 90, 180, 270])
+            variation = self.rng.randint(-5, 5)  # Reduced from -15,15 to -5,5
+            start_angle = (base_angle + variation) % 360
             
-            if not overlap:
-                # Use strict 90-degree increments with minimal variation
-                base_angle = self.rng.choice([0, 90, 180, 270])
-                variation = self.rng.randint(-5, 5)  # Reduced from -15,15 to -5,5
-                start_angle = (base_angle + variation) % 360
-                
-                # Size of the "mouth" - consistently around 90 degrees with minimal variation
-                mouth_size = 90 + self.rng.randint(-3, 3)  # Very small variation for consistency
-                end_angle = (start_angle + 360 - mouth_size) % 360
-                
-                # Make pacmans slightly smaller to allow for tighter packing
-                radius = self.pacman_radius * 0.9  # 10% smaller
-                self.create_pacman(x, y, start_angle, end_angle, radius)
-                pacmen_created += 1
+            # Size of the "mouth" - consistently around 90 degrees with minimal variation
+            mouth_size = 90 + self.rng.randint(-3, 3)  # Very small variation for consistency
+            end_angle = (start_angle + 360 - mouth_size) % 360
             
-            attempts += 1
+            # Make pacmans slightly smaller to allow for tighter packing
+            radius = self.pacman_radius * 0.9  # 10% smaller
+            self.create_pacman(x, y, start_angle, end_angle, radius)
+            pacmen_created += 1
     
     def create_kanizsa_triangle(self):
         """Create a Kanizsa triangle with slight irregularities"""
-        for attempt in range(20):
-            # Center point of the triangle
-            center_x = self.rng.randint(self.width // 6, 5 * self.width // 6)
-            center_y = self.rng.randint(self.height // 6, 5 * self.height // 6)
-            
-            # Size of the triangle (radius from center to corners)
-            size = self.rng.randint(self.cell_size * 2, self.cell_size * 3)
-            
-            # Base rotation with some variation
-            base_rotation = self.rng.randint(0, 360)
-            
-            # Triangle angles (approximately 120° apart with small variations)
-            angle_variation = self.rng.randint(-5, 5)  # Reduced variation for better readability
-            angle1 = base_rotation
-            angle2 = (base_rotation + 120 + angle_variation) % 360
-            angle3 = (base_rotation + 240 - angle_variation) % 360
-            
-            # Calculate corner positions
-            corner1_x = center_x + size * math.cos(math.radians(angle1))
-            corner1_y = center_y + size * math.sin(math.radians(angle1))
-            corner2_x = center_x + size * math.cos(math.radians(angle2))
-            corner2_y = center_y + size * math.sin(math.radians(angle2))
-            corner3_x = center_x + size * math.cos(math.radians(angle3))
-            corner3_y = center_y + size * math.sin(math.radians(angle3))
-            
-            # Check if all corners are within bounds
-            padding = self.cell_size
-            if (padding < corner1_x < self.width - padding and
-                padding < corner1_y < self.height - padding and
-                padding < corner2_x < self.width - padding and
-                padding < corner2_y < self.height - padding and
-                padding < corner3_x < self.width - padding and
-                padding < corner3_y < self.height - padding):
-                
-                # Check if the positions are free
-                grid_positions = [
-                    (int(corner1_x // self.cell_size), int(corner1_y // self.cell_size)),
-                    (int(corner2_x // self.cell_size), int(corner2_y // self.cell_size)),
-                    (int(corner3_x // self.cell_size), int(corner3_y // self.cell_size))
-                ]
-                
-                if any(pos in self.taken_positions for pos in grid_positions):
-                    continue  # Try again if any position is taken
-                
-                # Create pacman at each corner with mouth facing inward
-                # Use more consistent angles for better visibility
-                
-                # For corner 1, mouth points towards the triangle center
-                angle_to_center1 = math.degrees(math.atan2(center_y - corner1_y, center_x - corner1_x))
-                angle1_start = (angle_to_center1 - 45) % 360
-                angle1_end = (angle_to_center1 + 45) % 360
-                
-                # For corner 2
-                angle_to_center2 = math.degrees(math.atan2(center_y - corner2_y, center_x - corner2_x))
-                angle2_start = (angle_to_center2 - 45) % 360
-                angle2_end = (angle_to_center2 + 45) % 360
-                
-                # For corner 3
-                angle_to_center3 = math.degrees(math.atan2(center_y - corner3_y, center_x - corner3_x))
-                angle3_start = (angle_to_center3 - 45) % 360
-                angle3_end = (angle_to_center3 + 45) % 360
-                
-                # Create the pacmen
-                self.create_pacman(corner1_x, corner1_y, angle1_start, angle1_end)
-                self.create_pacman(corner2_x, corner2_y, angle2_start, angle2_end)
-                self.create_pacman(corner3_x, corner3_y, angle3_start, angle3_end)
-                
-                # Record this emergent shape
-                self.emergent_shapes.append({
-                    'type': 'triangle',
-                    'corners': [(corner1_x, corner1_y), (corner2_x, corner2_y), (corner3_x, corner3_y)],
-                    'size': size
-                })
-                
-                return True
-        
-        return False  # Failed to place triangle after max attempts
+        placement = self._place_triangle()
+        if placement is None:
+            return False  # Failed to place triangle
+        
+        corners, (center_x, center_y), size = placement
+        self._add_corner_pacmen(corners, center_x, center_y)
+        
+        # Record this emergent shape
+        self.emergent_shapes.append(EmergentShape('triangle', corners, size=size))
+        return True
     
     def create_kanizsa_rectangle(self):
         """Create a Kanizsa rectangle with better visibility"""
-        for attempt in range(20):
-            # Try to find a position for the rectangle
-            grid_x = self.rng.randint(1, self.cols - 5)
-            grid_y = self.rng.randint(1, self.rows - 5)
-            
-            # Rectangle dimensions (in grid cells)
-            width_cells = self.rng.randint(2, 4)
-            height_cells = self.rng.randint(2, 3)
-            
-            # Convert to pixel dimensions
-            width = width_cells * self.cell_size
-            height = height_cells * self.cell_size
-            
-            # Calculate corner positions (with less rotation for better visibility)
-            rotation = self.rng.randint(-10, 10)  # Reduced rotation
-            cos_rot = math.cos(math.radians(rotation))
-            sin_rot = math.sin(math.radians(rotation))
-            
-            # Calculate corner positions
-            start_x = grid_x * self.cell_size + self.cell_size // 2
-            start_y = grid_y * self.cell_size + self.cell_size // 2
-            
-            # Corners relative to start position
-            corners = [
-                (0, 0),  # Top-left
-                (width, 0),  # Top-right
-                (width, height),  # Bottom-right
-                (0, height)  # Bottom-left
-            ]
-            
-            # Apply rotation and translation
-            rotated_corners = []
-            for x, y in corners:
-                rx = start_x + (x * cos_rot - y * sin_rot)
-                ry = start_y + (x * sin_rot + y * cos_rot)
-                rotated_corners.append((rx, ry))
-            
-            # Check if all corners are within bounds
-            padding = self.cell_size
-            if all(padding < x < self.width - padding and padding < y < self.height - padding 
-                   for x, y in rotated_corners):
-                
-                # Check if these positions are available
-                grid_positions = [
-                    (int(x // self.cell_size), int(y // self.cell_size))
-                    for x, y in rotated_corners
-                ]
-                
-                if any(pos in self.taken_positions for pos in grid_positions):
-                    continue  # Try again if any position is taken
-                
-                # Calculate center of rectangle
-                center_x = start_x + (width/2 * cos_rot - height/2 * sin_rot)
-                center_y = start_y + (width/2 * sin_rot + height/2 * cos_rot)
-                
-                # Create pacmen at each corner with mouths pointing to create the illusory rectangle
-                for x, y in rotated_corners:
-                    # Angle from corner to center
-                    angle_to_center = math.degrees(math.atan2(center_y - y, center_x - x))
-                    
-                    # Pacman mouth points toward center ±45°
-                    angle1 = (angle_to_center - 45) % 360
-                    angle2 = (angle_to_center + 45) % 360
-                    
-                    self.create_pacman(x, y, angle1, angle2)
-                
-                # Record this emergent shape
-                self.emergent_shapes.append({
-                    'type': 'rectangle',
-                    'corners': rotated_corners,
-                    'rotation': rotation,
-                    'width': width,
-                    'height': height
-                })
-                
-                return True
-        
-        return False  # Failed to place rectangle after max attempts
+        # 2-4 by 2-3 cells, with less rotation for better visibility
+        placement = self._place_rectangle('rectangle', self.cols - 5, self.rows - 5,
+                                          (2, 4), (2, 3), 10)
+        if placement is None:
+            return False  # Failed to place rectangle
+        
+        corners, (center_x, center_y), rotation, width, height = placement
+        self._add_corner_pacmen(corners, center_x, center_y)
+        
+        # Record this emergent shape
+        self.emergent_shapes.append(EmergentShape(
+            'rectangle',
+            corners,
+            rotation=rotation,
+            width=width,
+            height=height
+        ))
+        return True
     
     def create_largest_rectangle(self):
         """Create a significantly larger Kanizsa rectangle as the target shape to identify"""
-        # Try multiple positions to find a good spot for the large rectangle
-        for attempt in range(30):  # More attempts to ensure success
-            # Position with some randomness but ensuring it fits
-            grid_x = self.rng.randint(1, self.cols - 7)  # Leave more space for larger rectangle
-            grid_y = self.rng.randint(1, self.rows - 7)
-            
-            # Make it larger than regular rectangles (5-7 cells wide, 4-6 cells tall)
-            # We can make larger rectangles now that we have more grid space
-            width_cells = self.rng.randint(5, 7)
-            height_cells = self.rng.randint(4, 6)
-            
-            # Convert to pixel dimensions
-            width = width_cells * self.cell_size
-            height = height_cells * self.cell_size
+        # 5-7 cells wide and 4-6 cells tall with very slight rotation, leaving
+        # more space at the grid edge for the larger rectangle
+        placement = self._place_rectangle('largest_rectangle', self.cols - 7, self.rows - 7,
+                                          (5, 7), (4, 6), 5)
+        if placement is None:
+            return False  # Failed to place the large rectangle
+        
+        corners, (center_x, center_y), rotation, width, height = placement
+        self._add_corner_pacmen(corners, center_x, center_y)
+        
+        # Record the corner grid positions as the expected response
+        corner_grid_positions = [
+            (int(x // self.cell_size), int(y // self.cell_size))
+            for x, y in corners
+        ]
+        
+        # Store this as the largest rectangle (with is_largest flag)
+        self.emergent_shapes.append(EmergentShape(
+            'rectangle',
+            corners,
+            corner_grid_positions=corner_grid_positions,
+            rotation=rotation,
+            width=width,
+            height=height,
+            is_largest=True
+        ))
+        return True
+    
+    def _add_corner_pacmen(self, corners, center_x, center_y):
+        # Mouths point toward the shape center ±45° to create the illusory contour
+        for x, y in corners:
+            angle_to_center = math.degrees(math.atan2(center_y - y, center_x - x))
+            self.create_pacman(x, y, (angle_to_center - 45) % 360, (angle_to_center + 45) % 360)
+    
+    def _free_placements(self, corners_x, corners_y):
+        """
+        Mask of the candidate placements whose corners are all inside the
+        padded canvas and on free grid cells.
+        
+        corners_x, corners_y: arrays of shape (candidates, corners)
+        """
+        padding = self.cell_size
+        inside = ((np.abs(corners_x - self.width / 2) < self.width / 2 - padding) &
+                  (np.abs(corners_y - self.height / 2) < self.height / 2 - padding))
+        
+        # Corners outside the grid are rejected already; clipping only keeps
+        # their cell indices valid
+        cells = (corners_y // self.cell_size) * self.cols + corners_x // self.cell_size
+        cells = np.clip(cells, 0, self.cols * self.rows - 1).astype(np.intp)
+        taken = np.frombuffer(self.occupancy.taken, dtype=np.uint8)
+        return (inside & (taken[cells] == 0)).all(axis=1)
+    
+    def _first_valid(self, shape, valid, batch):
+        # Candidates are independent draws, so the first valid one is as
+        # random as any; attempts count every candidate evaluated
+        index = int(valid.argmax())
+        if valid[index]:
+            metrics.PLACEMENT_ATTEMPTS.inc(batch * PLACEMENT_BATCH + index + 1, shape=shape)
+            return index
+        return None
+    
+    def _place_rectangle(self, shape, max_grid_x, max_grid_y, width_cells, height_cells, max_rotation):
+        """
+        Find a free placement for a rectangle, evaluating a batch of random
+        candidates at a time. Returns (corners, center, rotation, width,
+        height) or None if no batch had a valid candidate.
+        """
+        low = (1, 1, width_cells[0], height_cells[0], -max_rotation)
+        high = (max_grid_x, max_grid_y, width_cells[1], height_cells[1], max_rotation)
+        for batch in range(PLACEMENT_BATCHES):
+            # One row of (grid x, grid y, width cells, height cells, rotation)
+            # per candidate
+            params = self.np_rng.integers(low, high, (PLACEMENT_BATCH, 5), endpoint=True)
+            start = params[:, :2] * self.cell_size + self.cell_size // 2
+            size = params[:, 2:4] * self.cell_size
+            cos_rot = COS_DEGREES[params[:, 4]]
+            sin_rot = SIN_DEGREES[params[:, 4]]
             
-            # Very slight rotation for better visibility
-            rotation = self.rng.randint(-5, 5)
-            cos_rot = math.cos(math.radians(rotation))
-            sin_rot = math.sin(math.radians(rotation))
+            # Top-left, top-right, bottom-right and bottom-left corners
+            # relative to the start position, rotated and translated
+            local_x = size[:, :1] * RECTANGLE_CORNERS[0]
+            local_y = size[:, 1:] * RECTANGLE_CORNERS[1]
+            corners_x = start[:, :1] + (local_x * cos_rot[:, None] - local_y * sin_rot[:, None])
+            corners_y = start[:, 1:] + (local_x * sin_rot[:, None] + local_y * cos_rot[:, None])
             
-            # Calculate corner positions
-            start_x = grid_x * self.cell_size + self.cell_size // 2
-            start_y = grid_y * self.cell_size + self.cell_size // 2
+            index = self._first_valid(shape, self._free_placements(corners_x, corners_y), batch)
+            if index is None:
+                continue
             
-            # Corners relative to start position
-            corners = [
-                (0, 0),  # Top-left
-                (width, 0),  # Top-right
-                (width, height),  # Bottom-right
-                (0, height)  # Bottom-left
-            ]
+            start_x, start_y = start[index].tolist()
+            width, height = size[index].tolist()
+            rotation = int(params[index, 4])
+            cos_i, sin_i = float(cos_rot[index]), float(sin_rot[index])
+            center = (start_x + (width / 2 * cos_i - height / 2 * sin_i),
+                      start_y + (width / 2 * sin_i + height / 2 * cos_i))
+            corners = list(zip(corners_x[index].tolist(), corners_y[index].tolist()))
+            return corners, center, rotation, width, height
+        
+        metrics.PLACEMENT_ATTEMPTS.inc(PLACEMENT_BATCHES * PLACEMENT_BATCH, shape=shape)
+        metrics.PLACEMENT_FAILURES.inc(shape=shape)
+        return None
+    
+    def _place_triangle(self):
+        """
+        Find a free placement for a triangle, evaluating a batch of random
+        candidates at a time. Returns (corners, center, size) or None.
+        """
+        # Center point, size (radius from center to corners), base rotation
+        # and the variation of the corners from 120° apart
+        low = (self.width // 6, self.height // 6, self.cell_size * 2, 0, -5)
+        high = (5 * self.width // 6, 5 * self.height // 6, self.cell_size * 3, 360, 5)
+        for batch in range(PLACEMENT_BATCHES):
+            params = self.np_rng.integers(low, high, (PLACEMENT_BATCH, 5), endpoint=True)
+            angles = (params[:, 3:4] + TRIANGLE_ANGLES[0] + params[:, 4:5] * TRIANGLE_ANGLES[1]) % 360
+            radius = params[:, 2:3]
+            corners_x = params[:, :1] + radius * COS_DEGREES[angles]
+            corners_y = params[:, 1:2] + radius * SIN_DEGREES[angles]
             
-            # Apply rotation and translation
-            rotated_corners = []
-            for x, y in corners:
-                rx = start_x + (x * cos_rot - y * sin_rot)
-                ry = start_y + (x * sin_rot + y * cos_rot)
-                rotated_corners.append((rx, ry))
+            index = self._first_valid('triangle', self._free_placements(corners_x, corners_y), batch)
+            if index is None:
+                continue
             
-            # Check if all corners are within bounds
-            padding = self.cell_size
-            if all(padding < x < self.width - padding and padding < y < self.height - padding 
-                   for x, y in rotated_corners):
-                
-                # Check if these positions are available
-                grid_positions = [
-                    (int(x // self.cell_size), int(y // self.cell_size))
-                    for x, y in rotated_corners
-                ]
-                
-                if any(pos in self.taken_positions for pos in grid_positions):
-                    continue  # Try again if any position is taken
-                
-                # Calculate center of rectangle
-                center_x = start_x + (width/2 * cos_rot - height/2 * sin_rot)
-                center_y = start_y + (width/2 * sin_rot + height/2 * cos_rot)
-                
-                # Create pacmen at each corner with mouths pointing to create the illusory rectangle
-                for x, y in rotated_corners:
-                    # Angle from corner to center
-                    angle_to_center = math.degrees(math.atan2(center_y - y, center_x - x))
-                    
-                    # Pacman mouth points toward center ±45°
-                    angle1 = (angle_to_center - 45) % 360
-                    angle2 = (angle_to_center + 45) % 360
-                    
-                    self.create_pacman(x, y, angle1, angle2)
-                
-                # Record the corner grid positions as the expected response
-                corner_grid_positions = []
-                for x, y in rotated_corners:
-                    grid_x = int(x // self.cell_size)
-                    grid_y = int(y // self.cell_size)
-                    corner_grid_positions.append((grid_x, grid_y))
-                
-                # Store this as the largest rectangle (with is_largest flag)
-                self.emergent_shapes.append({
-                    'type': 'rectangle',
-                    'corners': rotated_corners,
-                    'corner_grid_positions': corner_grid_positions,
-                    'rotation': rotation,
-                    'width': width,
-                    'height': height,
-                    'is_largest': True
-                })
-                
-                return True
-        
-        return False  # Failed to place the large rectangle
+            center_x, center_y, size, _, _ = params[index].tolist()
+            corners = list(zip(corners_x[index].tolist(), corners_y[index].tolist()))
+            return corners, (center_x, center_y), size
+        
+        metrics.PLACEMENT_ATTEMPTS.inc(PLACEMENT_BATCHES * PLACEMENT_BATCH, shape='triangle')
+        metrics.PLACEMENT_FAILURES.inc(shape='triangle')
+        return None
     
     def create_multiple_shapes(self):
         """Create multiple Kanizsa shapes - both rectangles and triangles"""
@@ -431,59 +683,278 @@ class GeometricCaptcha:
         self.expected_count = shapes_created
         return shapes_created
     
-    def get_image_data_url(self):
+    def get_image_bytes(self, encoder=DEFAULT_ENCODER):
+        """Encode the image with one of the registered encoders"""
+        if is_vector(encoder):
+            return self.scene.to_svg().encode('utf-8')
+        if self.image is None:
+            raise ValueError("The svg backend can only be used with vector encoders")
+        return encode_image(self.image, encoder)
+    
+    def get_image_data_url(self, encoder=DEFAULT_ENCODER):
         """Convert the image to a data URL for embedding in HTML"""
-        buffer = io.BytesIO()
-        self.image.save(buffer, format='PNG')
-        img_str = base64.b64encode(buffer.getvalue()).decode('utf-8')
-        return f"data:image/png;base64,{img_str}"
+        img_str = base64.b64encode(self.get_image_bytes(encoder)).decode('utf-8')
+        return f"data:{ENCODERS[encoder]['mimetype']};base64,{img_str}"
+    
+    def release(self):
+        """Drop the canvas and drawing handle once the image has been encoded"""
+        self.image = None
+        self.draw = None
+    
+    def generate(self, encoder=DEFAULT_ENCODER, release=True):
+        """
+        Generate a complete CAPTCHA with a largest rectangle challenge.
+        The canvas is released after encoding unless release is False.
+        """
+        with metrics.GENERATE_SECONDS.time():
+            return self._generate(encoder, release)
     
-    def generate(self):
-        """Generate a complete CAPTCHA with a largest rectangle challenge"""
+    def place_shapes(self):
+        """
+        Place the largest rectangle and the distractor shapes, which decide
+        the answer and the difficulty of a seed. Returns False if the
+        largest rectangle did not fit
+        """
         # First create the largest rectangle
-        if not self.create_largest_rectangle():
-            # If creation fails (very unlikely), try again with a different seed
-            return generate_captcha(None)
+        with metrics.STAGE_SECONDS.time(stage='largest_rectangle'):
+            if not self.create_largest_rectangle():
+                return False
         
         # Then create a few regular shapes as distractors
-        num_distractors = self.rng.randint(3, 5)
-        for _ in range(num_distractors):
-            if self.rng.random() < 0.6:  # More rectangles than triangles for consistency
-                self.create_kanizsa_rectangle()
-            else:
-                self.create_kanizsa_triangle()
+        with metrics.STAGE_SECONDS.time(stage='distractors'):
+            num_distractors = self.rng.randint(3, 5)
+            for _ in range(num_distractors):
+                if self.rng.random() < 0.6:  # More rectangles than triangles for consistency
+                    self.create_kanizsa_rectangle()
+                else:
+                    self.create_kanizsa_triangle()
+        return True
+    
+    def _generate(self, encoder, release):
+        if not self.place_shapes():
+            # If creation fails (very unlikely), try again with a different seed
+            metrics.GENERATE_RETRIES.inc()
+            retry = GeometricCaptcha(self.width, self.height, backend=self.backend, mode=self.mode)
+            return retry._generate(encoder, release)
         
         # Fill in the rest with grid-based pacmen
-        self.create_grid_pacmen()
+        with metrics.STAGE_SECONDS.time(stage='grid_pacmen'):
+            self.create_grid_pacmen()
+        
+        if self.backend == 'numpy':
+            with metrics.STAGE_SECONDS.time(stage='rasterize_pacmen'):
+                self.rasterize_pacmen()
         
         # Add grid coordinates last so they're on top
-        self.add_grid_coordinates()
+        with metrics.STAGE_SECONDS.time(stage='grid_coordinates'):
+            self.add_grid_coordinates()
         
         # Find the largest rectangle to get its corner coordinates
-        largest_rectangle = next((s for s in self.emergent_shapes if s.get('is_largest')), None)
-        corner_coords = []
+        largest_rectangle = next((s for s in self.emergent_shapes if s.is_largest), None)
+        expected_answer = []
         
         if largest_rectangle:
-            # Extract the grid coordinates of the 4 corners
-            corner_coords = largest_rectangle['corner_grid_positions']
+            # The grid coordinates of the 4 corners, already flattened as
+            # integers in clockwise order, starting from top-left
+            expected_answer = list(largest_rectangle.corner_grid_positions)
         
-        # Format as integers in clockwise order, starting from top-left
-        # This gives us 4 integers for the challenge
-        expected_answer = [coord for pos in corner_coords for coord in pos]
+        with metrics.STAGE_SECONDS.time(stage='encode'):
+            image_bytes = self.get_image_bytes(encoder)
+        if release:
+            self.release()
         
         return {
             'seed': self.seed,
             'expected_count': 4,  # Now we expect 4 corner coordinates
             'expected_answer': expected_answer,  # Store the actual coordinates
-            'image_data': self.get_image_data_url(),
+            'image_bytes': image_bytes,
+            'image_format': encoder,
+            'width': self.width,
+            'height': self.height,
             'challenge_type': 'largest_rectangle'
         }
 
-def generate_captcha(seed=None):
+class RenderCache:
+    """
+    Thread-safe LRU cache of rendered CAPTCHAs, bounded by the total size of
+    the encoded images rather than by the number of entries.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """Return the cached CAPTCHA for a key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return entry.to_dict()
+    
+    def put(self, captcha_data):
+        """Add a rendered CAPTCHA, evicting the least recently used ones"""
+        key = render_key(captcha_data['seed'], captcha_data['width'], captcha_data['height'],
+                         captcha_data['image_format'])
+        size = len(captcha_data['image_bytes'])
+        if size > self.max_bytes:
+            return
+        
+        entry = RenderedCaptcha.from_dict(captcha_data)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= len(previous.image_bytes)
+            self._entries[key] = entry
+            self.current_bytes += size
+            self._evict()
+    
+    def resize(self, max_bytes):
+        """Change the byte budget, evicting entries if necessary"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+    
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.current_bytes -= len(evicted.image_bytes)
+
+def render_key(seed, width=720, height=720, encoder=DEFAULT_ENCODER):
+    """Cache key identifying a rendered image by its seed and generator parameters"""
+    return (seed, width, height, GENERATOR_VERSION, encoder)
+
+def render_etag(seed, width=720, height=720, encoder=DEFAULT_ENCODER):
+    """Stable entity tag for the image rendered from a seed"""
+    return hashlib.sha1(repr(render_key(seed, width, height, encoder)).encode()).hexdigest()
+
+# Process-wide cache shared by generate_captcha and regenerate_captcha
+render_cache = RenderCache()
+
+def render_captcha(seed=None, encoder=DEFAULT_ENCODER):
+    """Render a CAPTCHA without touching the render cache"""
+    # Draw directly in the encoder's image mode so nothing is converted, and
+    # skip the raster entirely for vector output
+    backend = 'svg' if is_vector(encoder) else 'pillow'
+    captcha = GeometricCaptcha(seed=seed, backend=backend, mode=encoder_mode(encoder))
+    return captcha.generate(encoder)
+
+def generate_captcha(seed=None, encoder=DEFAULT_ENCODER):
     """Helper function to generate a CAPTCHA"""
-    captcha = GeometricCaptcha(seed=seed)
-    return captcha.generate()
+    captcha_data = render_captcha(seed, encoder)
+    render_cache.put(captcha_data)
+    return captcha_data
+
+def regenerate_captcha(seed, encoder=DEFAULT_ENCODER):
+    """Regenerate a CAPTCHA with the same seed, reusing a cached render if possible"""
+    captcha_data = render_cache.get(render_key(seed, encoder=encoder))
+    if captcha_data is None:
+        captcha_data = generate_captcha(seed, encoder)
+    return captcha_data
+
+def expected_count(seed, width=720, height=720):
+    """
+    Expected count of the challenge rendered from a seed, or None if its
+    largest rectangle does not fit. Only the shapes are placed; nothing is
+    rasterized
+    """
+    captcha = GeometricCaptcha(width, height, seed=seed, backend='svg')
+    if not captcha.place_shapes():
+        return None
+    largest = next(shape for shape in captcha.emergent_shapes if shape.is_largest)
+    # One answer per corner; the grid positions are flattened (x, y) pairs
+    return len(largest.corner_grid_positions) // 2
+
+def warm_up(encoders=None, seed='warm-up'):
+    """
+    Pay the first-render costs of this process up front: one trial render
+    per encoder loads the fonts, the blank canvas and coordinate labels of
+    each image mode and the image plugins. Returns the time taken in seconds
+    """
+    # Trial renders are not served, so they are kept out of the metrics
+    enabled, metrics.enabled = metrics.enabled, False
+    start = time.perf_counter()
+    try:
+        for name in encoders or list(ENCODERS):
+            render_captcha(seed, name)
+    finally:
+        metrics.enabled = enabled
+    return time.perf_counter() - start
+
+def encoder_report(seeds, encoders=None):
+    """
+    Encode the images rendered from a fixed list of seeds with each encoder,
+    returning the mean/max encoded size and encode time per encoder
+    """
+    report = []
+    for name in encoders or list(ENCODERS):
+        sizes = []
+        timings = []
+        for seed in seeds:
+            captcha = GeometricCaptcha(seed=seed, mode=encoder_mode(name))
+            captcha.generate(name, release=False)
+            start = time.perf_counter()
+            sizes.append(len(captcha.get_image_bytes(name)))
+            timings.append(time.perf_counter() - start)
+        report.append({
+            'encoder': name,
+            'mimetype': ENCODERS[name]['mimetype'],
+            'mean_bytes': sum(sizes) / len(sizes),
+            'max_bytes': max(sizes),
+            'mean_ms': 1000 * sum(timings) / len(timings),
+            'max_ms': 1000 * max(timings)
+        })
+    return report
+
+def rss_kb(field):
+    """Current (VmRSS) or peak (VmHWM) resident set size in KB; Linux only"""
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    raise OSError(f'{field} not reported')
+
+def reset_peak_rss():
+    """Reset the peak resident set size (VmHWM) of this process; Linux 4.0+ only"""
+    # Writing 5 to clear_refs resets VmHWM
+    with open('/proc/self/clear_refs', 'w') as clear_refs:
+        clear_refs.write('5')
+
+def _measure_render_rss(seed, encoder):
+    # Runs in a fresh process. A warm-up render loads fonts, static layers
+    # and image plugins first, so that only the render itself is counted.
+    render_captcha(seed + '-warmup', encoder)
+    try:
+        reset_peak_rss()
+        before = rss_kb('VmRSS')
+        render_captcha(seed, encoder)
+        return rss_kb('VmHWM') - before
+    except OSError:
+        # No resettable peak: fall back to ru_maxrss, which also counts
+        # whatever the warm-up render left resident
+        import resource
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        render_captcha(seed, encoder)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        return peak // 1024 if sys.platform == 'darwin' else peak
 
-def regenerate_captcha(seed):
-    """Regenerate a CAPTCHA with the same seed"""
-    return generate_captcha(seed) 
\ No newline at end of file
+def render_memory_report(seed='memory-report', encoders=None):
+    """
+    Measure the peak RSS growth caused by one render with each encoder.
+    Every measurement runs in a fresh worker process, since peak RSS never
+    goes down within a process.
+    """
+    report = []
+    for name in encoders or list(ENCODERS):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            peak_kb = executor.submit(_measure_render_rss, seed, name).result()
+        mode = 'svg' if is_vector(name) else encoder_mode(name)
+        report.append({'encoder': name, 'mode': mode, 'peak_rss_kb': peak_kb})
+    return report
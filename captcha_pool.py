@@ -0,0 +1,155 @@
+import os
+import atexit
+import threading
+from collections import deque
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import current_app
+
+from captcha_generator import generate_captcha, render_captcha, render_cache, RenderedCaptcha, DEFAULT_ENCODER
+
+class CaptchaPool:
+    """
+    A bounded pool of pre-rendered CAPTCHA challenges.
+
+    A background process pool renders challenges ahead of time. Whenever the
+    number of ready (plus in-flight) challenges drops below the low
+    watermark, the pool is topped back up to the high watermark.
+    """
+    def __init__(self, low_watermark=8, high_watermark=32, workers=2, encoder=DEFAULT_ENCODER):
+        if not 0 <= low_watermark <= high_watermark:
+            raise ValueError('Watermarks must satisfy 0 <= low <= high')
+
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.workers = workers
+        self.encoder = encoder
+
+        self.hits = 0
+        self.misses = 0
+
+        self._ready = deque()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._closed = False
+
+    def get(self, render=True):
+        """
+        Pop a ready challenge. If the pool is empty, render one inline, or
+        return None when render is False
+        """
+        with self._lock:
+            entry = self._ready.popleft() if self._ready else None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        self.refill()
+
+        if entry is None:
+            return generate_captcha(encoder=self.encoder) if render else None
+
+        captcha_data = entry.to_dict()
+
+        # Make the image available to the image endpoint without re-rendering
+        render_cache.put(captcha_data)
+        return captcha_data
+
+    def refill(self):
+        """Schedule background renders if the pool is below its low watermark"""
+        with self._lock:
+            if self._closed:
+                return
+            available = len(self._ready) + self._pending
+            if available >= self.low_watermark and available > 0:
+                return
+            needed = self.high_watermark - available
+            self._pending += needed
+
+        executor = self._get_executor()
+        submitted = 0
+        try:
+            for _ in range(needed):
+                future = executor.submit(render_captcha, None, self.encoder)
+                future.add_done_callback(partial(self._on_rendered, executor))
+                submitted += 1
+        except BrokenProcessPool:
+            # A worker died: forget the renders that were never scheduled and
+            # start a new executor on the next refill; get() renders inline
+            # meanwhile
+            with self._lock:
+                self._pending -= needed - submitted
+            self._drop_executor(executor)
+
+    def stats(self):
+        """Return the pool counters as a dict"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'ready': len(self._ready),
+                'pending': self._pending,
+            }
+
+    def close(self):
+        """Stop the worker processes and drop any queued renders"""
+        with self._lock:
+            self._closed = True
+            executor, self._executor = self._executor, None
+            self._ready.clear()
+
+        if executor is not None and self._pid == os.getpid():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _get_executor(self):
+        # An executor inherited across fork() is unusable, so each process
+        # starts its own workers on first use
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _drop_executor(self, executor):
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _on_rendered(self, executor, future):
+        failed = not future.cancelled() and future.exception() is not None
+        if failed and isinstance(future.exception(), BrokenProcessPool):
+            self._drop_executor(executor)
+        with self._lock:
+            self._pending -= 1
+            if self._closed or future.cancelled() or failed:
+                return
+            if len(self._ready) < self.high_watermark:
+                # Keep ready challenges in their compact __slots__ form
+                self._ready.append(RenderedCaptcha.from_dict(future.result()))
+
+def get_pool():
+    """Return the app's CAPTCHA pool, or None if pre-rendering is disabled"""
+    return current_app.extensions.get('captcha_pool')
+
+def init_app(app):
+    app.config.setdefault('CAPTCHA_POOL_WORKERS', 2)
+    app.config.setdefault('CAPTCHA_POOL_LOW_WATERMARK', 8)
+    app.config.setdefault('CAPTCHA_POOL_HIGH_WATERMARK', 32)
+
+    if app.config['CAPTCHA_POOL_WORKERS'] <= 0:
+        return
+
+    pool = CaptchaPool(
+        low_watermark=app.config['CAPTCHA_POOL_LOW_WATERMARK'],
+        high_watermark=app.config['CAPTCHA_POOL_HIGH_WATERMARK'],
+        workers=app.config['CAPTCHA_POOL_WORKERS'],
+        encoder=app.config.get('CAPTCHA_IMAGE_FORMATS', [DEFAULT_ENCODER])[0],
+    )
+    app.extensions['captcha_pool'] = pool
+    atexit.register(pool.close)
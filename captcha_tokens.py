@@ -0,0 +1,105 @@
+import hmac
+import base64
+import hashlib
+import secrets
+from flask import current_app
+from itsdangerous import URLSafeTimedSerializer, BadData
+
+from captcha_generator import GENERATOR_VERSION
+
+# Signed, expiring challenge tokens. A token carries everything needed to
+# rebuild and check a challenge, so issuing one needs no database write.
+# Signing only stops tampering: the payload is readable base64 JSON, and the
+# generator is open source, so the seed is sealed with a keystream derived
+# from the secret key and the token's nonce. The expected count is not in
+# the token at all; it is derived from the seed on verify.
+
+# Tokens from before the seed was sealed fail to verify under this salt
+TOKEN_SALT = 'captcha-challenge-sealed'
+SEED_SALT = b'captcha-seed'
+
+def _serializer(salt=TOKEN_SALT):
+    return URLSafeTimedSerializer(current_app.secret_key, salt=salt)
+
+def _keystream(nonce, length):
+    # HMAC-SHA256 of the nonce and a block counter; nonces are never reused,
+    # so neither is the keystream
+    key = current_app.secret_key
+    key = key.encode() if isinstance(key, str) else key
+    stream = b''
+    counter = 0
+    while len(stream) < length:
+        stream += hmac.new(key, SEED_SALT + f':{nonce}:{counter}'.encode(), hashlib.sha256).digest()
+        counter += 1
+    return stream[:length]
+
+def seal_seed(seed, nonce):
+    """Encrypt a seed for a token with the given nonce"""
+    data = seed.encode()
+    sealed = bytes(a ^ b for a, b in zip(data, _keystream(nonce, len(data))))
+    return base64.urlsafe_b64encode(sealed).decode()
+
+def open_seed(sealed, nonce):
+    """Decrypt a seed sealed by seal_seed"""
+    data = base64.urlsafe_b64decode(sealed)
+    return bytes(a ^ b for a, b in zip(data, _keystream(nonce, len(data)))).decode()
+
+def issue_token(captcha_data):
+    """Sign a token for a generated CAPTCHA"""
+    # Tells apart tokens issued for the same seed, so each is consumed once
+    nonce = secrets.token_urlsafe(12)
+    return _serializer().dumps({
+        's': seal_seed(captcha_data['seed'], nonce),
+        'v': GENERATOR_VERSION,
+        'n': nonce,
+    })
+
+def load_token(token):
+    """
+    Return (seed, nonce) for a valid token, or None if the token is forged,
+    expired or was issued by a different generator version
+    """
+    try:
+        payload = _serializer().loads(token, max_age=current_app.config['CAPTCHA_TOKEN_MAX_AGE'])
+    except BadData:
+        return None
+
+    # The same seed renders a different image after a generator change
+    if payload.get('v') != GENERATOR_VERSION:
+        return None
+    return open_seed(payload['s'], payload['n']), payload['n']
+
+# Batch tickets wrap the session state a challenge would otherwise leave in
+# the session, so a client can hold many challenges at once
+TICKET_SALT = 'captcha-ticket'
+
+def issue_ticket(challenge_session):
+    """Sign the session state of one challenge as a ticket"""
+    return _serializer(TICKET_SALT).dumps(dict(challenge_session))
+
+def load_ticket(ticket):
+    """Return the session state signed into a ticket, or None if it is invalid or expired"""
+    try:
+        return _serializer(TICKET_SALT).loads(ticket, max_age=current_app.config['CAPTCHA_TOKEN_MAX_AGE'])
+    except BadData:
+        return None
+
+# Asteroid boards are rebuilt from their seed and size, so a board token is
+# all the state an asteroid challenge needs
+BOARD_SALT = 'asteroid-board'
+
+def issue_board_token(board):
+    """Sign a token for an asteroid board"""
+    return _serializer(BOARD_SALT).dumps({
+        's': board.seed,
+        'c': board.count,
+        'n': secrets.token_urlsafe(12),
+    })
+
+def load_board_token(token):
+    """Return (seed, count, nonce) for a valid board token, or None if it is forged or expired"""
+    try:
+        payload = _serializer(BOARD_SALT).loads(token, max_age=current_app.config['CAPTCHA_TOKEN_MAX_AGE'])
+    except BadData:
+        return None
+    return payload['s'], payload['c'], payload['n']
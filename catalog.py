@@ -0,0 +1,222 @@
+import os
+import time
+import random
+import secrets
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from captcha_generator import GeometricCaptcha, GENERATOR_VERSION
+from database import connect
+
+# Seed catalog: placement metadata of pre-screened seeds, bucketed by difficulty.
+#
+# The builder runs only the shape placement of GeometricCaptcha for each new
+# seed (nothing is rasterized) and records the largest rectangle's size,
+# rotation and answer and the mix of distractors. Within each difficulty
+# bucket seeds are numbered by a dense slot, so a random seed of a bucket is
+# one primary key lookup of a random slot below the bucket's size. The
+# generator version is kept in PRAGMA user_version, since the same seed
+# places different shapes after a generator change.
+
+DIFFICULTIES = ('easy', 'medium', 'hard')
+
+# Upper bounds of the difficulty score of the easy and medium buckets,
+# which split random seeds into roughly equal thirds
+DIFFICULTY_THRESHOLDS = (1.4, 1.8)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS seed_catalog (
+    difficulty INTEGER NOT NULL,
+    slot INTEGER NOT NULL,
+    seed TEXT NOT NULL,
+    width_cells INTEGER NOT NULL,
+    height_cells INTEGER NOT NULL,
+    rotation INTEGER NOT NULL,
+    rectangles INTEGER NOT NULL,
+    triangles INTEGER NOT NULL,
+    answer BLOB NOT NULL,
+    PRIMARY KEY (difficulty, slot)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS catalog_buckets (
+    difficulty INTEGER PRIMARY KEY,
+    seeds INTEGER NOT NULL
+);
+"""
+
+class CatalogError(ValueError):
+    """Raised when a seed catalog was built by a different generator version"""
+
+def difficulty_score(width_cells, height_cells, rotation, rectangles):
+    """
+    Score from 0 to 3: a smaller target, a stronger tilt and more distractor
+    rectangles to confuse it with each make a seed harder
+    """
+    size = (42 - width_cells * height_cells) / 22  # 5x4 to 7x6 cells
+    tilt = abs(rotation) / 5
+    clutter = rectangles / 5
+    return size + tilt + clutter
+
+def difficulty_bucket(score):
+    for bucket, threshold in enumerate(DIFFICULTY_THRESHOLDS):
+        if score < threshold:
+            return bucket
+    return len(DIFFICULTY_THRESHOLDS)
+
+def describe_seed(seed, width=720, height=720):
+    """
+    Place the shapes of a seed and return its catalog row (without a slot),
+    or None when its largest rectangle does not fit
+    """
+    captcha = GeometricCaptcha(width, height, seed=seed, backend='svg')
+    if not captcha.place_shapes():
+        return None
+
+    largest = next(shape for shape in captcha.emergent_shapes if shape.is_largest)
+    distractors = [shape for shape in captcha.emergent_shapes if not shape.is_largest]
+    width_cells = int(largest.width // captcha.cell_size)
+    height_cells = int(largest.height // captcha.cell_size)
+    rectangles = sum(shape.type == 'rectangle' for shape in distractors)
+    triangles = len(distractors) - rectangles
+
+    score = difficulty_score(width_cells, height_cells, largest.rotation, rectangles)
+    return (difficulty_bucket(score), seed, width_cells, height_cells, largest.rotation,
+            rectangles, triangles, largest.corner_grid_positions.tobytes())
+
+def describe_new_seeds(count):
+    """Catalog rows for count fresh random seeds; runs in the builder's worker processes"""
+    rows = (describe_seed(secrets.token_hex(16)) for _ in range(count))
+    return [row for row in rows if row is not None]
+
+def open_catalog(path):
+    """Open a catalog for writing, creating it if needed"""
+    db = connect(path)
+    # Only the builder writes to a catalog; without WAL files it can also be
+    # read from a read-only directory
+    db.execute('PRAGMA journal_mode=DELETE')
+    db.executescript(SCHEMA)
+    version = db.execute('PRAGMA user_version').fetchone()[0]
+    if version and version != GENERATOR_VERSION:
+        db.close()
+        raise CatalogError('Cannot add to a catalog built by a different generator version')
+    db.execute(f'PRAGMA user_version = {GENERATOR_VERSION}')
+    return db
+
+def add_seeds(db, rows):
+    """Append catalog rows to their buckets in one transaction"""
+    with db:
+        sizes = {row['difficulty']: row['seeds'] for row in db.execute('SELECT difficulty, seeds FROM catalog_buckets')}
+        numbered = []
+        for row in rows:
+            slot = sizes.get(row[0], 0)
+            sizes[row[0]] = slot + 1
+            numbered.append((row[0], slot, *row[1:]))
+        db.executemany('INSERT INTO seed_catalog VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', numbered)
+        db.executemany(
+            'INSERT INTO catalog_buckets (difficulty, seeds) VALUES (?, ?) '
+            'ON CONFLICT (difficulty) DO UPDATE SET seeds = excluded.seeds',
+            sizes.items()
+        )
+
+class SeedCatalog:
+    """
+    Read-only view of a seed catalog. Bucket sizes are read once, so seeds
+    added later are used after a restart
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+        db = self._open()
+        try:
+            self.generator_version = db.execute('PRAGMA user_version').fetchone()[0]
+            self.sizes = dict(db.execute('SELECT difficulty, seeds FROM catalog_buckets').fetchall())
+        finally:
+            db.close()
+
+    def __len__(self):
+        return sum(self.sizes.values())
+
+    def random_seed(self, difficulty, rng=random):
+        """A random seed of a difficulty bucket, or None if the bucket is empty"""
+        bucket = DIFFICULTIES.index(difficulty)
+        size = self.sizes.get(bucket)
+        if not size:
+            return None
+        row = self._connection().execute(
+            'SELECT seed FROM seed_catalog WHERE difficulty = ? AND slot = ?', (bucket, rng.randrange(size))
+        ).fetchone()
+        return row[0] if row else None
+
+    def _open(self):
+        return sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+
+    def _connection(self):
+        # One connection per thread, reopened in forked worker processes
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.db = self._open()
+            self._local.pid = os.getpid()
+        return self._local.db
+
+def get_catalog():
+    """Return the app's seed catalog, or None if there is none"""
+    return current_app.extensions.get('seed_catalog')
+
+@click.command('build-catalog')
+@click.option('--count', default=100000, help='Number of seeds to try.')
+@click.option('--workers', default=os.cpu_count(), help='Number of placement processes.')
+@click.option('--chunk-size', default=1000, help='Seeds placed per task and written per transaction.')
+@click.option('--output', type=click.Path(dir_okay=False), default=None,
+              help='Catalog file to add to (defaults to CAPTCHA_CATALOG).')
+@with_appcontext
+def build_catalog_command(count, workers, chunk_size, output):
+    """Place shapes for new seeds and add them to the seed catalog."""
+    output = output or current_app.config['CAPTCHA_CATALOG']
+    if not output:
+        raise click.UsageError('Set CAPTCHA_CATALOG or pass --output')
+    try:
+        db = open_catalog(output)
+    except CatalogError as e:
+        raise click.ClickException(str(e))
+
+    chunks = [chunk_size] * (count // chunk_size) + ([count % chunk_size] if count % chunk_size else [])
+    added = 0
+    start = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            with click.progressbar(length=count, label='Placing') as bar:
+                for chunk, rows in zip(chunks, executor.map(describe_new_seeds, chunks)):
+                    add_seeds(db, rows)
+                    added += len(rows)
+                    bar.update(chunk)
+        sizes = dict(db.execute('SELECT difficulty, seeds FROM catalog_buckets').fetchall())
+    finally:
+        db.close()
+
+    elapsed = time.perf_counter() - start
+    click.echo(f'Added {added} seeds to {output} in {elapsed:.1f}s, {count / elapsed:.0f} per second.')
+    click.echo(', '.join(f'{name}: {sizes.get(bucket, 0)}' for bucket, name in enumerate(DIFFICULTIES)))
+
+def init_app(app):
+    app.config.setdefault('CAPTCHA_CATALOG', None)
+    app.cli.add_command(build_catalog_command)
+
+    path = app.config['CAPTCHA_CATALOG']
+    if not path or not os.path.exists(path):
+        return
+
+    try:
+        catalog = SeedCatalog(path)
+    except sqlite3.DatabaseError as e:
+        app.logger.warning('Ignoring seed catalog %s: %s', path, e)
+        return
+
+    if catalog.generator_version != GENERATOR_VERSION or not len(catalog):
+        app.logger.warning('Ignoring seed catalog %s: empty or built by another generator version', path)
+        return
+
+    app.extensions['seed_catalog'] = catalog
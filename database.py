@@ -1,29 +1,213 @@
+import os
+import queue
+import logging
+import atexit
 import sqlite3
+import threading
+import time
+import zlib
 import click
 from flask import current_app, g
 from flask.cli import with_appcontext
 
-def get_db():
-    if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+import metrics
+
+# Pragmas applied to every connection. WAL lets readers proceed while a
+# writer commits, and synchronous=NORMAL only fsyncs at checkpoints in WAL mode.
+# auto_vacuum only takes effect on new files, and must come before WAL; it
+# lets retention hand freed pages back with PRAGMA incremental_vacuum.
+PRAGMAS = (
+    'PRAGMA auto_vacuum=INCREMENTAL',
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-8000',
+)
+
+# Connections reused by each worker thread, keyed by database path
+_local = threading.local()
+
+def connect(path):
+    """Open a tuned connection to the database at path"""
+    db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+    db.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        db.execute(pragma)
+    return db
+
+def _thread_connection(path):
+    # A connection inherited across fork() must not be used, so connections
+    # are also keyed by process id
+    connections = getattr(_local, 'connections', None)
+    if connections is None or _local.pid != os.getpid():
+        connections = _local.connections = {}
+        _local.pid = os.getpid()
+
+    db = connections.get(path)
+    if db is None:
+        db = connections[path] = connect(path)
+    return db
+
+# With DATABASE_SHARDS set, captchas and their responses are spread over that
+# many files. A captcha id is its row id within its shard times the number of
+# shards plus the shard number, so every id routes straight to one file.
+
+def database_paths(config):
+    """Database files in shard order; just DATABASE unless sharding is enabled"""
+    shards = config.get('DATABASE_SHARDS', 1)
+    if shards <= 1:
+        return [config['DATABASE']]
+    return [config['DATABASE_SHARD_PATH'].format(shard=shard) for shard in range(shards)]
+
+def shard_count():
+    """Number of database files of the current app"""
+    return max(current_app.config.get('DATABASE_SHARDS', 1), 1)
 
-    return g.db
+def split_id(captcha_id, shards):
+    """Return (shard, row id within the shard) for a captcha id"""
+    return captcha_id % shards, captcha_id // shards
+
+def join_id(shard, row_id, shards):
+    """Return the captcha id of a row in a shard"""
+    return row_id * shards + shard
+
+def seed_shard(seed, shards):
+    # Hashing the seed keeps every row for one stateless seed in one shard
+    return zlib.crc32(seed.encode('utf8')) % shards
+
+def get_db(shard=0):
+    if 'dbs' not in g:
+        g.dbs = {}
+
+    db = g.dbs.get(shard)
+    if db is None:
+        path = database_paths(current_app.config)[shard]
+        if current_app.config.get('DATABASE_REUSE_CONNECTIONS', True):
+            db = g.dbs[shard] = _thread_connection(path)
+        else:
+            db = g.dbs[shard] = connect(path)
+
+    return db
 
 def close_db(e=None):
-    db = g.pop('db', None)
+    dbs = g.pop('dbs', {})
     
-    if db is not None:
-        db.close()
+    for db in dbs.values():
+        if current_app.config.get('DATABASE_REUSE_CONNECTIONS', True):
+            # Keep the connection for the next request on this thread, but
+            # never leave a transaction open across requests
+            if db.in_transaction:
+                db.rollback()
+        else:
+            db.close()
+
+class ResponseWriter:
+    """
+    Write-behind queue for response inserts.
+
+    Responses are queued by the request handlers and inserted by a background
+    thread in batched transactions, flushed whenever batch_size responses are
+    waiting or flush_interval seconds have passed. Queued responses are
+    drained when the process exits. Each batch is split by shard and written
+    to the database files in paths with one transaction per shard. When a
+    batch fails, its responses are retried one by one and the failing ones
+    are logged and dropped.
+    """
+    def __init__(self, paths, batch_size=100, flush_interval=0.5, logger=None):
+        self.paths = paths
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.logger = logger or logging.getLogger(__name__)
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def put(self, captcha_id, user_count, ip_address):
+        """Queue a response for insertion"""
+        self._ensure_started()
+        self._queue.put((captcha_id, user_count, ip_address))
+
+    def close(self):
+        """Flush everything still queued and stop the writer thread"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and self._pid == os.getpid():
+            self._queue.put(None)
+            thread.join()
+
+    def _ensure_started(self):
+        with self._lock:
+            # A writer thread that died is replaced as well, and takes over
+            # its queue; a forked process starts from an empty one
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='response-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        dbs = [connect(path) for path in self.paths]
+        try:
+            stopping = False
+            while not stopping:
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    timeout = deadline - time.monotonic()
+                    try:
+                        item = self._queue.get(timeout=max(timeout, 0)) if batch else self._queue.get()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+                if batch:
+                    try:
+                        self._write(dbs, batch)
+                    except Exception:
+                        self.logger.exception('Dropped a batch of %d queued responses', len(batch))
+        finally:
+            for db in dbs:
+                db.close()
+
+    def _write(self, dbs, batch):
+        by_shard = {}
+        for captcha_id, user_count, ip_address in batch:
+            shard, row_id = split_id(captcha_id, len(dbs))
+            by_shard.setdefault(shard, []).append((row_id, user_count, ip_address))
+
+        for shard, responses in by_shard.items():
+            db = dbs[shard]
+            try:
+                self._insert(db, responses)
+            except sqlite3.Error:
+                self.logger.exception('Batch insert of %d responses failed; retrying them one by one', len(responses))
+                for response in responses:
+                    try:
+                        self._insert(db, [response])
+                    except sqlite3.Error:
+                        self.logger.exception('Dropped response %r', response)
+
+    def _insert(self, db, responses):
+        with db:
+            insert_responses(db, responses)
+            with metrics.COMMIT_SECONDS.time(query='insert_responses'):
+                db.commit()
+
+def get_response_writer():
+    """Return the app's write-behind response writer, or None if disabled"""
+    return current_app.extensions.get('response_writer')
 
 def init_db():
-    db = get_db()
-    
     with current_app.open_resource('schema.sql') as f:
-        db.executescript(f.read().decode('utf8'))
+        schema = f.read().decode('utf8')
+    
+    for shard in range(shard_count()):
+        get_db(shard).executescript(schema)
 
 @click.command('init-db')
 @with_appcontext
@@ -32,48 +216,328 @@ def init_db_command():
     init_db()
     click.echo('Initialized the database.')
 
+# Creates the consensus tables on databases initialized before they existed
+# and rebuilds them from the response log
+TALLIES_MIGRATION = """
+CREATE INDEX IF NOT EXISTS responses_captcha_id ON responses (captcha_id);
+
+CREATE TABLE IF NOT EXISTS response_tallies (
+    captcha_id INTEGER NOT NULL,
+    answer INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (captcha_id, answer)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS response_modes (
+    captcha_id INTEGER PRIMARY KEY,
+    answer INTEGER NOT NULL,
+    count INTEGER NOT NULL
+);
+
+DELETE FROM response_tallies;
+DELETE FROM response_modes;
+
+INSERT INTO response_tallies (captcha_id, answer, count)
+SELECT captcha_id, user_count, COUNT(*)
+FROM responses
+GROUP BY captcha_id, user_count;
+
+INSERT INTO response_modes (captcha_id, answer, count)
+SELECT captcha_id, answer, MAX(count)
+FROM response_tallies
+GROUP BY captcha_id;
+"""
+
+@click.command('migrate-tallies')
+@with_appcontext
+def migrate_tallies_command():
+    """Create the consensus tallies and backfill them from existing responses."""
+    count = 0
+    for shard in range(shard_count()):
+        db = get_db(shard)
+        db.executescript('BEGIN;' + TALLIES_MIGRATION + 'COMMIT;')
+        count += db.execute('SELECT COUNT(*) FROM response_modes').fetchone()[0]
+    click.echo(f'Backfilled consensus tallies for {count} captchas.')
+
+# Daily rollup tables written by retention, as (table, key columns, count columns)
+ROLLUP_TABLES = (
+    ('daily_responses', ('day', 'answer'), ('count',)),
+    ('daily_ip_responses', ('day', 'ip_address'), ('count',)),
+    ('daily_captchas', ('day',), ('captchas', 'answered', 'consensus_expected')),
+)
+
+@click.command('shard-db')
+@click.option('--source', default=None,
+              help='Database to copy from (defaults to DATABASE), or a path with {shard} if it is sharded.')
+@click.option('--source-shards', default=1, help='Number of shards of the source, if it is sharded too.')
+@click.option('--batch-size', default=10000, help='Rows copied per statement.')
+@with_appcontext
+def shard_db_command(source, source_shards, batch_size):
+    """Create the shard files and copy every captcha and response into them."""
+    shards = shard_count()
+    if shards <= 1:
+        raise click.UsageError('Set DATABASE_SHARDS to the number of shards first')
+
+    source = source or current_app.config['DATABASE']
+    if source_shards > 1:
+        sources = [source.format(shard=shard) for shard in range(source_shards)]
+    else:
+        sources = [source]
+    missing = [path for path in sources if not os.path.exists(path)]
+    if missing:
+        raise click.UsageError(f'Source database not found: {missing[0]}')
+    targets = database_paths(current_app.config)
+    if set(sources) & set(targets):
+        raise click.UsageError('The source and the shard files must be different files')
+
+    # Shard files are recreated from scratch, so ids keep their meaning:
+    # every captcha lands in the shard its existing id routes to
+    init_db()
+    dbs = [get_db(shard) for shard in range(shards)]
+    captchas = responses = 0
+    for source_shard, path in enumerate(sources):
+        # Timestamps are copied as stored, so the source is read without type conversion
+        source_db = sqlite3.connect(path)
+        source_db.row_factory = sqlite3.Row
+        try:
+            # Sources from before one-shot consumption have no consumed_at
+            columns = [row['name'] for row in source_db.execute('PRAGMA table_info(captchas)')]
+            consumed_at = 'consumed_at' if 'consumed_at' in columns else 'NULL'
+            rows = source_db.execute(f'SELECT id, seed, expected_count, created_at, {consumed_at} FROM captchas')
+            while True:
+                batch = rows.fetchmany(batch_size)
+                if not batch:
+                    break
+                for db, shard_rows in zip(dbs, _route_rows(batch, source_shard, source_shards, shards)):
+                    db.executemany(
+                        'INSERT INTO captchas (id, seed, expected_count, created_at, consumed_at) VALUES (?, ?, ?, ?, ?)',
+                        shard_rows
+                    )
+                captchas += len(batch)
+
+            rows = source_db.execute('SELECT captcha_id, user_count, ip_address, created_at FROM responses')
+            while True:
+                batch = rows.fetchmany(batch_size)
+                if not batch:
+                    break
+                for db, shard_rows in zip(dbs, _route_rows(batch, source_shard, source_shards, shards)):
+                    db.executemany(
+                        'INSERT INTO responses (captcha_id, user_count, ip_address, created_at) VALUES (?, ?, ?, ?)',
+                        shard_rows
+                    )
+                responses += len(batch)
+
+            tables = {row['name'] for row in source_db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            if 'consumed_tokens' in tables:
+                for nonce, expires_at in source_db.execute('SELECT nonce, expires_at FROM consumed_tokens'):
+                    dbs[seed_shard(nonce, shards)].execute(
+                        'INSERT OR IGNORE INTO consumed_tokens (nonce, expires_at) VALUES (?, ?)',
+                        (nonce, expires_at)
+                    )
+
+            # Rollups are sums, so the archive of every source is added up
+            # in the first shard
+            for table, key, counts in ROLLUP_TABLES:
+                if table not in tables:
+                    continue
+                columns = key + counts
+                updates = ', '.join(f'{column} = {column} + excluded.{column}' for column in counts)
+                rows = source_db.execute(f'SELECT {", ".join(columns)} FROM {table}')
+                dbs[0].executemany(
+                    f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))}) '
+                    f'ON CONFLICT ({", ".join(key)}) DO UPDATE SET {updates}',
+                    rows
+                )
+        finally:
+            source_db.close()
+
+    for db in dbs:
+        db.commit()
+        db.executescript('BEGIN;' + TALLIES_MIGRATION + 'COMMIT;')
+    click.echo(f'Copied {captchas} captchas and {responses} responses into {shards} shards.')
+
+# Adds one-shot consumption to databases initialized before it existed, and
+# the seed index stateless challenges find their row with
+ONE_SHOT_MIGRATION = """
+CREATE INDEX IF NOT EXISTS captchas_seed ON captchas (seed);
+
+CREATE TABLE IF NOT EXISTS consumed_tokens (
+    nonce TEXT PRIMARY KEY,
+    expires_at TIMESTAMP NOT NULL
+) WITHOUT ROWID;
+"""
+
+@click.command('migrate-one-shot')
+@with_appcontext
+def migrate_one_shot_command():
+    """Add the columns, tables and indexes used to consume challenges once."""
+    for shard in range(shard_count()):
+        db = get_db(shard)
+        columns = [row['name'] for row in db.execute('PRAGMA table_info(captchas)')]
+        script = ONE_SHOT_MIGRATION
+        if 'consumed_at' not in columns:
+            script = 'ALTER TABLE captchas ADD COLUMN consumed_at TIMESTAMP;' + script
+        db.executescript('BEGIN;' + script + 'COMMIT;')
+    click.echo('Added one-shot consumption.')
+
+def _route_rows(rows, source_shard, source_shards, shards):
+    # Rows start with a shard-local captcha id of the source; split them by
+    # target shard with the id rewritten for it
+    routed = [[] for _ in range(shards)]
+    for row in rows:
+        shard, row_id = split_id(join_id(source_shard, row[0], source_shards), shards)
+        routed[shard].append((row_id, *row[1:]))
+    return routed
+
 def init_app(app):
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_tallies_command)
+    app.cli.add_command(shard_db_command)
+    app.cli.add_command(migrate_one_shot_command)
+
+    if app.config.get('DATABASE_WRITE_BEHIND'):
+        writer = ResponseWriter(
+            database_paths(app.config),
+            batch_size=app.config.get('DATABASE_WRITE_BEHIND_BATCH_SIZE', 100),
+            flush_interval=app.config.get('DATABASE_WRITE_BEHIND_INTERVAL', 0.5),
+            logger=app.logger,
+        )
+        app.extensions['response_writer'] = writer
+        atexit.register(writer.close)
 
 def store_captcha(seed, expected_count):
-    db = get_db()
-    cursor = db.execute(
-        'INSERT INTO captchas (seed, expected_count) VALUES (?, ?)',
-        (seed, expected_count)
-    )
-    db.commit()
-    return cursor.lastrowid
+    shards = shard_count()
+    shard = seed_shard(seed, shards)
+    db = get_db(shard)
+    with metrics.QUERY_SECONDS.time(query='store_captcha'):
+        cursor = db.execute(
+            'INSERT INTO captchas (seed, expected_count) VALUES (?, ?)',
+            (seed, expected_count)
+        )
+    with metrics.COMMIT_SECONDS.time(query='store_captcha'):
+        db.commit()
+    return join_id(shard, cursor.lastrowid, shards)
 
-def store_response(captcha_id, user_count, ip_address):
-    db = get_db()
-    db.execute(
+def get_or_create_captcha(seed, expected_count):
+    """Return the id of the captcha row for a seed, creating it on first use"""
+    shards = shard_count()
+    shard = seed_shard(seed, shards)
+    db = get_db(shard)
+    # A single INSERT ... SELECT runs under the write lock, so concurrent
+    # first responses for the same seed still create only one row
+    with metrics.QUERY_SECONDS.time(query='get_or_create_captcha'):
+        db.execute(
+            '''
+            INSERT INTO captchas (seed, expected_count)
+            SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM captchas WHERE seed = ?)
+            ''',
+            (seed, expected_count, seed)
+        )
+    with metrics.COMMIT_SECONDS.time(query='get_or_create_captcha'):
+        db.commit()
+    row_id = db.execute(
+        'SELECT id FROM captchas WHERE seed = ? ORDER BY id LIMIT 1', (seed,)
+    ).fetchone()['id']
+    return join_id(shard, row_id, shards)
+
+def consume_captcha(captcha_id):
+    """
+    Mark a captcha as used. Returns True only for the first call per captcha;
+    concurrent calls from any process race on one conditional UPDATE
+    """
+    shard, row_id = split_id(captcha_id, shard_count())
+    db = get_db(shard)
+    with metrics.QUERY_SECONDS.time(query='consume_captcha'):
+        cursor = db.execute(
+            'UPDATE captchas SET consumed_at = CURRENT_TIMESTAMP WHERE id = ? AND consumed_at IS NULL',
+            (row_id,)
+        )
+    with metrics.COMMIT_SECONDS.time(query='consume_captcha'):
+        db.commit()
+    return cursor.rowcount == 1
+
+def consume_token(nonce, max_age):
+    """
+    Mark a stateless challenge token as used until it would have expired
+    anyway. Returns True only for the first call per token
+    """
+    db = get_db(seed_shard(nonce, shard_count()))
+    with metrics.QUERY_SECONDS.time(query='consume_token'):
+        cursor = db.execute(
+            "INSERT OR IGNORE INTO consumed_tokens (nonce, expires_at) VALUES (?, datetime('now', ?))",
+            (nonce, f'+{int(max_age)} seconds')
+        )
+    with metrics.COMMIT_SECONDS.time(query='consume_token'):
+        db.commit()
+    return cursor.rowcount == 1
+
+def insert_responses(db, responses):
+    """
+    Insert (captcha_id, user_count, ip_address) rows and update the consensus
+    tallies, without committing. Captcha ids are row ids within db's shard.
+    """
+    with metrics.QUERY_SECONDS.time(query='insert_responses'):
+        _insert_responses(db, responses)
+
+def _insert_responses(db, responses):
+    db.executemany(
         'INSERT INTO responses (captcha_id, user_count, ip_address) VALUES (?, ?, ?)',
-        (captcha_id, user_count, ip_address)
+        responses
     )
-    db.commit()
+
+    answers = [(captcha_id, user_count) for captcha_id, user_count, _ in responses]
+    db.executemany(
+        '''
+        INSERT INTO response_tallies (captcha_id, answer, count) VALUES (?, ?, 1)
+        ON CONFLICT (captcha_id, answer) DO UPDATE SET count = count + 1
+        ''',
+        answers
+    )
+    # An answer only takes over the mode once it has strictly more responses,
+    # so ties keep the answer that got there first
+    db.executemany(
+        '''
+        INSERT INTO response_modes (captcha_id, answer, count)
+        SELECT captcha_id, answer, count FROM response_tallies
+        WHERE captcha_id = ? AND answer = ?
+        ON CONFLICT (captcha_id) DO UPDATE SET answer = excluded.answer, count = excluded.count
+        WHERE excluded.count > response_modes.count
+        ''',
+        answers
+    )
+
+def store_response(captcha_id, user_count, ip_address):
+    writer = get_response_writer()
+    if writer is not None:
+        writer.put(captcha_id, user_count, ip_address)
+        return
+
+    shard, row_id = split_id(captcha_id, shard_count())
+    db = get_db(shard)
+    insert_responses(db, [(row_id, user_count, ip_address)])
+    with metrics.COMMIT_SECONDS.time(query='insert_responses'):
+        db.commit()
 
 def get_captcha(captcha_id):
-    db = get_db()
-    return db.execute(
-        'SELECT * FROM captchas WHERE id = ?', (captcha_id,)
-    ).fetchone()
+    shard, row_id = split_id(captcha_id, shard_count())
+    db = get_db(shard)
+    with metrics.QUERY_SECONDS.time(query='get_captcha'):
+        return db.execute(
+            'SELECT ? AS id, seed, expected_count, created_at, consumed_at FROM captchas WHERE id = ?',
+            (captcha_id, row_id)
+        ).fetchone()
 
 def get_most_common_response(captcha_id):
-    db = get_db()
-    result = db.execute(
-        '''
-        SELECT user_count, COUNT(*) as count 
-        FROM responses 
-        WHERE captcha_id = ? 
-        GROUP BY user_count 
-        ORDER BY count DESC 
-        LIMIT 1
-        ''', 
-        (captcha_id,)
-    ).fetchone()
+    shard, row_id = split_id(captcha_id, shard_count())
+    db = get_db(shard)
+    with metrics.QUERY_SECONDS.time(query='get_most_common_response'):
+        result = db.execute(
+            'SELECT answer FROM response_modes WHERE captcha_id = ?',
+            (row_id,)
+        ).fetchone()
     
     if result is None:
         return None
     
-    return result['user_count'] 
\ No newline at end of file
+    return result['answer'] 
\ No newline at end of file
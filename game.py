@@ -1,4 +1,181 @@
+import math
+import heapq
+import random
+import hashlib
 
+# Server-side engine for the asteroid aura puzzle (see asteroids.html).
+#
+# Asteroids are spheres in a cube of side space_size centred on the origin,
+# each surrounded by an aura aura_ratio times its radius. Two asteroids
+# conflict when their auras intersect, and a solution is a set of asteroids
+# with no conflicts between them (an independent set of the conflict graph).
+# Neighbours are found through a spatial hash with cells as large as the
+# longest possible conflict distance, so each asteroid is only compared with
+# the asteroids in its own and the 26 surrounding cells.
 
+# The 27 cells a conflict can reach, relative to an asteroid's own cell
+NEIGHBOUR_CELLS = [(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)]
 
-class Board:
\ No newline at end of file
+# Reference layout of asteroids.html; larger boards keep its density
+REFERENCE_COUNT = 64
+REFERENCE_SPACE_SIZE = 16
+
+class SpatialHash:
+    """Uniform grid of point indices for fixed-radius neighbour queries"""
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def cell(self, position):
+        x, y, z = position
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size), math.floor(z / self.cell_size))
+
+    def add(self, index, position):
+        self.cells.setdefault(self.cell(position), []).append(index)
+
+    def nearby(self, position):
+        """Indices in the cells around a position, a superset of those within cell_size"""
+        cx, cy, cz = self.cell(position)
+        for dx, dy, dz in NEIGHBOUR_CELLS:
+            yield from self.cells.get((cx + dx, cy + dy, cz + dz), ())
+
+class Board:
+    """
+    Seeded asteroid layout with its conflict graph.
+
+    Asteroid ids run from 1 to count, as in asteroids.html; internally
+    asteroid i has id i + 1.
+    """
+    def __init__(self, seed=None, count=REFERENCE_COUNT, space_size=None, min_radius=0.5, max_radius=0.9,
+                 aura_ratio=2.5, max_attempts=100):
+        if count < 1:
+            raise ValueError('A board needs at least one asteroid')
+
+        self.seed = seed if seed else hashlib.md5(str(random.random()).encode()).hexdigest()
+        self.rng = random.Random(self.seed)
+        self.count = count
+        # Without an explicit size the space grows with the asteroid count,
+        # so conflicts per asteroid stay as in the reference layout
+        self.space_size = space_size or REFERENCE_SPACE_SIZE * (count / REFERENCE_COUNT) ** (1 / 3)
+        self.min_radius = min_radius
+        self.max_radius = max_radius
+        self.aura_ratio = aura_ratio
+        self.max_attempts = max_attempts
+
+        self.positions = []
+        self.radii = []
+        self.aura_radii = []
+        self._conflicts = None
+
+        self._generate()
+
+    def _random_position(self):
+        half = self.space_size / 2
+        return (self.rng.uniform(-half, half), self.rng.uniform(-half, half), self.rng.uniform(-half, half))
+
+    def _generate(self):
+        # Asteroids keep a little room between their bodies when possible;
+        # bodies are never further apart than their auras can reach, so the
+        # conflict grid also serves the spacing check
+        grid = SpatialHash(2 * self.max_radius * self.aura_ratio)
+        for index in range(self.count):
+            radius = self.rng.uniform(self.min_radius, self.max_radius)
+            for _ in range(self.max_attempts):
+                position = self._random_position()
+                if all(math.dist(position, self.positions[other]) >= (radius + self.radii[other]) * 1.2
+                       for other in grid.nearby(position)):
+                    break
+            else:
+                # No room found; any position will do
+                position = self._random_position()
+
+            self.positions.append(position)
+            self.radii.append(radius)
+            self.aura_radii.append(radius * self.aura_ratio)
+            grid.add(index, position)
+
+    @property
+    def conflicts(self):
+        """Adjacency sets of the conflict graph, one set of indices per asteroid"""
+        if self._conflicts is None:
+            self._conflicts = self.detect_conflicts()
+        return self._conflicts
+
+    def detect_conflicts(self):
+        """Build the conflict graph with the spatial hash instead of comparing all pairs"""
+        grid = SpatialHash(2 * self.max_radius * self.aura_ratio)
+        conflicts = [set() for _ in range(self.count)]
+        for index, position in enumerate(self.positions):
+            aura = self.aura_radii[index]
+            # Each pair is found once: only asteroids already in the grid are checked
+            for other in grid.nearby(position):
+                if math.dist(position, self.positions[other]) < aura + self.aura_radii[other]:
+                    conflicts[index].add(other)
+                    conflicts[other].add(index)
+            grid.add(index, position)
+        return conflicts
+
+    def conflict_count(self):
+        """Number of conflicting pairs"""
+        return sum(len(neighbours) for neighbours in self.conflicts) // 2
+
+    def independent_set(self):
+        """
+        Reference solution: a greedy maximal independent set, as ids.
+
+        The asteroid with the fewest conflicts left among the remaining ones
+        is taken first (the highest id on ties, as in asteroids.html), and
+        its neighbours are removed. Degrees change as asteroids are removed,
+        so the heap is updated lazily: stale entries are skipped when popped.
+        """
+        conflicts = self.conflicts
+        degree = [len(neighbours) for neighbours in conflicts]
+        removed = [False] * self.count
+        heap = [(degree[index], -index) for index in range(self.count)]
+        heapq.heapify(heap)
+
+        selected = []
+        while heap:
+            current, negative_index = heapq.heappop(heap)
+            index = -negative_index
+            if removed[index] or current != degree[index]:
+                continue
+            selected.append(index)
+            removed[index] = True
+            for neighbour in conflicts[index]:
+                if removed[neighbour]:
+                    continue
+                removed[neighbour] = True
+                # Asteroids next to a removed one lose a conflict
+                for affected in conflicts[neighbour]:
+                    if not removed[affected]:
+                        degree[affected] -= 1
+                        heapq.heappush(heap, (degree[affected], -affected))
+        return sorted(index + 1 for index in selected)
+
+    def is_independent(self, ids):
+        """Check that ids are distinct asteroids of this board with no conflicts between them"""
+        indices = set()
+        for asteroid_id in ids:
+            if not isinstance(asteroid_id, int) or isinstance(asteroid_id, bool) or not 1 <= asteroid_id <= self.count:
+                return False
+            indices.add(asteroid_id - 1)
+        if len(indices) != len(ids):
+            return False
+        return all(indices.isdisjoint(self.conflicts[index]) for index in indices)
+
+    def to_dict(self):
+        """Layout in the form used by asteroids.html"""
+        return {
+            'seed': self.seed,
+            'space_size': self.space_size,
+            'asteroids': [
+                {
+                    'id': index + 1,
+                    'position': [round(coordinate, 4) for coordinate in position],
+                    'radius': round(self.radii[index], 4),
+                    'aura_radius': round(self.aura_radii[index], 4),
+                }
+                for index, position in enumerate(self.positions)
+            ],
+        }
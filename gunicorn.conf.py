@@ -0,0 +1,86 @@
+import os
+import gc
+import time
+
+# Prefork serving with gunicorn:
+#
+#   gunicorn -c gunicorn.conf.py
+#   gunicorn -c gunicorn.conf.py --workers 8 --bind 0.0.0.0:8000
+#
+# The app is imported once in the master (preload_app) and warmed there with
+# a trial render per image format, which loads Pillow, NumPy, the fonts and
+# the cached canvases and label masks. Warmed objects are then moved out of
+# the garbage collector's reach with gc.freeze(), so collections in the
+# workers do not write to them and the forked workers keep sharing those
+# pages copy-on-write. Cold start, warm-up time and memory of the master and
+# of every worker are logged.
+
+# Taken when gunicorn reads this file, before the app is imported
+_config_loaded = time.perf_counter()
+
+wsgi_app = 'app:app'
+bind = '127.0.0.1:8000'
+workers = os.cpu_count() or 1
+preload_app = True
+
+def memory_kb():
+    """Resident, proportional and private memory of this process in KB, or None off Linux"""
+    fields = {}
+    try:
+        with open('/proc/self/smaps_rollup') as smaps:
+            for line in smaps:
+                name, _, value = line.partition(':')
+                if value.strip().endswith('kB'):
+                    fields[name] = int(value.split()[0])
+    except OSError:
+        return None
+    return {
+        'rss': fields.get('Rss', 0),
+        'pss': fields.get('Pss', 0),
+        'private': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0),
+    }
+
+def format_memory():
+    memory = memory_kb()
+    if memory is None:
+        return 'memory not reported'
+    return f"RSS {memory['rss']} KB, PSS {memory['pss']} KB, {memory['private']} KB private"
+
+def when_ready(server):
+    # With preload_app the app is already imported, so this only looks it up
+    from app import app
+    from captcha_generator import warm_up
+
+    warm_up_seconds = warm_up(app.config['CAPTCHA_IMAGE_FORMATS'])
+    gc.collect()
+    gc.freeze()
+    server.log.info('Cold start took %.0f ms, %.0f ms of it warming up; master %s',
+                    (time.perf_counter() - _config_loaded) * 1000, warm_up_seconds * 1000, format_memory())
+
+def post_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+    worker.first_request_logged = False
+
+def post_worker_init(worker):
+    from app import app
+
+    worker.log.info('Worker %s ready %.1f ms after fork; %s',
+                    worker.pid, (time.perf_counter() - worker.forked_at) * 1000, format_memory())
+    # Each worker has its own pre-rendering pool; filling it now means the
+    # first generate request does not have to render inline
+    pool = app.extensions.get('captcha_pool')
+    if pool is not None:
+        pool.refill()
+
+def pre_request(worker, req):
+    worker.request_started = time.perf_counter()
+
+def post_request(worker, req, environ, resp):
+    # The first request shows whether the warm-up paid off, and how many
+    # shared pages it copied
+    if worker.first_request_logged:
+        return
+    worker.first_request_logged = True
+    worker.log.info('Worker %s served its first request (%s %s) in %.1f ms; %s',
+                    worker.pid, req.method, req.path, (time.perf_counter() - worker.request_started) * 1000,
+                    format_memory())
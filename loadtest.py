@@ -0,0 +1,321 @@
+import re
+import sys
+import json
+import time
+import random
+import threading
+import http.client
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit
+import click
+
+from bench import percentile
+
+# Load generator for a running server (flask run, gunicorn or asgi.py).
+#
+#   python loadtest.py run --url http://127.0.0.1:5000 --users 20 --duration 30
+#   python loadtest.py run --mix generate=1,crowd=1 --json results.json
+#   python loadtest.py replay access.jsonl --users 10
+#
+# Each virtual user keeps its own connection and session cookie, so the
+# session-based generate -> verify flow works as it does in a browser.
+
+# Challenges expect the four corners of the largest rectangle
+DEFAULT_ANSWER = 4
+
+DEFAULT_MIX = 'generate=2,correct=4,wrong=3,crowd=1,spam=1'
+
+# Paths are reported per route, not per challenge
+ROUTE_PATTERNS = (
+    # Tokens contain dots, so only a trailing extension is kept
+    (re.compile(r'/captcha/t/[^/]+?(?=\.(?:png|svg)$|$)'), '/captcha/t/<token>'),
+    (re.compile(r'/\d+(?=[./]|$)'), '/<id>'),
+)
+
+def route_name(method, path):
+    """Group a request under its method and route, e.g. 'GET /captcha/<id>'"""
+    path = path.split('?', 1)[0]
+    for pattern, replacement in ROUTE_PATTERNS:
+        path = pattern.sub(replacement, path)
+    return f'{method} {path}'
+
+class Stats:
+    """Latencies and status counts per route, shared by all virtual users"""
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+    def record(self, route, status, seconds):
+        with self._lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            counts = self.statuses.setdefault(route, {})
+            counts[status] = counts.get(status, 0) + 1
+
+    def summary(self, elapsed):
+        """Throughput, error count and latency percentiles per route, in milliseconds"""
+        with self._lock:
+            routes = {route: list(samples) for route, samples in self.latencies.items()}
+            statuses = {route: dict(counts) for route, counts in self.statuses.items()}
+
+        summary = {}
+        for route, samples in sorted(routes.items()):
+            errors = sum(count for status, count in statuses[route].items()
+                         if status == 'error' or int(status) >= 400)
+            summary[route] = {
+                'requests': len(samples),
+                'errors': errors,
+                'rps': len(samples) / elapsed,
+                'p50_ms': percentile(samples, 0.50) * 1000,
+                'p95_ms': percentile(samples, 0.95) * 1000,
+                'p99_ms': percentile(samples, 0.99) * 1000,
+                'max_ms': max(samples) * 1000,
+                'statuses': statuses[route],
+            }
+        return summary
+
+class VirtualUser:
+    """One client with a keep-alive connection and its own session cookies"""
+    def __init__(self, url, stats, timeout=30):
+        parts = urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.stats = stats
+        self.cookies = {}
+        self._connection = None
+
+    def request(self, method, path, body=None):
+        """Send one request, returning (status, parsed JSON or raw body), or (None, None) on a connection error"""
+        headers = {}
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{name}={value}' for name, value in self.cookies.items())
+
+        route = route_name(method, path)
+        start = time.perf_counter()
+        try:
+            if self._connection is None:
+                self._connection = self.connection_class(self.netloc, timeout=self.timeout)
+            self._connection.request(method, self.prefix + path, body, headers)
+            response = self._connection.getresponse()
+            content = response.read()
+        except (OSError, http.client.HTTPException):
+            self.stats.record(route, 'error', time.perf_counter() - start)
+            self.close()
+            return None, None
+        self.stats.record(route, str(response.status), time.perf_counter() - start)
+
+        for header in response.headers.get_all('Set-Cookie') or ():
+            for name, morsel in SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+
+        if response.headers.get_content_type() == 'application/json':
+            return response.status, json.loads(content)
+        return response.status, content
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def generate(self):
+        """Fetch a challenge and its image, returning the challenge or None"""
+        status, challenge = self.request('POST', '/generate-captcha')
+        if status != 200:
+            return None
+        self.request('GET', challenge['image_url'])
+        return challenge
+
+    def generate_batch(self, count):
+        """Fetch a batch of challenges, returning their NDJSON lines as dicts"""
+        status, content = self.request('POST', f'/generate-captcha/batch?count={count}')
+        if status != 200:
+            return []
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+    def verify(self, count, ticket=None):
+        body = {'count': count}
+        if ticket is not None:
+            body['ticket'] = ticket
+        self.request('POST', '/verify-captcha', body)
+
+# Scenarios are one iteration of a virtual user
+def generate_scenario(user, options):
+    user.generate()
+
+def correct_scenario(user, options):
+    if user.generate():
+        user.verify(options['answer'])
+
+def wrong_scenario(user, options):
+    if user.generate():
+        user.verify(options['answer'] + random.randint(1, 3))
+
+def crowd_scenario(user, options):
+    # Answers a batch of challenges, each through its own ticket, so every
+    # verify is a first verify that goes through consensus and the response
+    # write path. With a pack or catalog in stateless mode, seeds repeat
+    # and share a row, so consensus is taken over many responses
+    for challenge in user.generate_batch(options['crowd_size']):
+        wrong = random.random() < 0.25
+        user.verify(options['answer'] + (random.randint(1, 3) if wrong else 0), challenge['ticket'])
+
+def spam_scenario(user, options):
+    # Replays one challenge's session cookie, so every verify after the
+    # first is turned away by replay rejection and never reaches consensus
+    if user.generate():
+        cookies = dict(user.cookies)
+        for _ in range(options['spam_count']):
+            user.cookies = dict(cookies)
+            user.verify(options['answer'])
+
+SCENARIOS = {
+    'generate': generate_scenario,
+    'correct': correct_scenario,
+    'wrong': wrong_scenario,
+    'crowd': crowd_scenario,
+    'spam': spam_scenario,
+}
+
+def parse_mix(mix):
+    """Parse 'name=weight,...' into a list of (scenario, weight)"""
+    weights = []
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise ValueError(f'Unknown scenario: {name!r}')
+        weights.append((name, float(weight or 1)))
+    return weights
+
+def load_log(path):
+    """
+    Read a JSONL request log. Lines need 'method' and 'path' and may carry a
+    JSON 'body' and 't', the offset in seconds from the start of the log;
+    other lines are skipped
+    """
+    entries = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(entry, dict) and 'method' in entry and 'path' in entry:
+                entries.append(entry)
+    return entries
+
+def run_users(url, users, target, timeout):
+    """Run target(user) on users threads at once, returning (stats, elapsed seconds)"""
+    stats = Stats()
+
+    def work():
+        user = VirtualUser(url, stats, timeout)
+        try:
+            target(user)
+        finally:
+            user.close()
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(users)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats, time.perf_counter() - start
+
+def run_load(url, users=10, duration=30.0, mix=DEFAULT_MIX, answer=DEFAULT_ANSWER, spam_count=20, timeout=30,
+             crowd_size=20):
+    """Run a weighted mix of scenarios for duration seconds and summarize it per route"""
+    names, weights = zip(*parse_mix(mix))
+    options = {'answer': answer, 'spam_count': spam_count, 'crowd_size': crowd_size}
+    deadline = time.monotonic() + duration
+
+    def target(user):
+        while time.monotonic() < deadline:
+            SCENARIOS[random.choices(names, weights)[0]](user, options)
+
+    stats, elapsed = run_users(url, users, target, timeout)
+    return stats.summary(elapsed), elapsed
+
+def replay_log(url, entries, users=10, speed=None, timeout=30):
+    """
+    Replay log entries in order on every virtual user. With speed set, the
+    't' offsets of the entries are honoured, scaled by 1/speed
+    """
+    def target(user):
+        start = time.monotonic()
+        for entry in entries:
+            if speed and 't' in entry:
+                delay = start + entry['t'] / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            user.request(entry['method'].upper(), entry['path'], entry.get('body'))
+
+    stats, elapsed = run_users(url, users, target, timeout)
+    return stats.summary(elapsed), elapsed
+
+def print_summary(summary, elapsed):
+    click.echo(f"{'route':<34} {'requests':>8} {'errors':>6} {'rps':>8} "
+               f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for route, row in summary.items():
+        click.echo(f"{route:<34} {row['requests']:>8} {row['errors']:>6} {row['rps']:>8.1f} "
+                   f"{row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f} {row['p99_ms']:>8.2f} {row['max_ms']:>8.2f}")
+    total = sum(row['requests'] for row in summary.values())
+    click.echo(f'{total} requests in {elapsed:.1f}s, {total / elapsed:.1f} per second')
+
+def write_json(path, summary, elapsed, meta):
+    with open(path, 'w') as f:
+        json.dump({'meta': {**meta, 'elapsed': elapsed}, 'routes': summary}, f, indent=2)
+
+@click.group()
+def cli():
+    """Load tests against a running CAPTCHA server."""
+
+@cli.command('run')
+@click.option('--url', default='http://127.0.0.1:5000', help='Base URL of the server.')
+@click.option('--users', default=10, help='Concurrent virtual users.')
+@click.option('--duration', default=30.0, help='Seconds to run for.')
+@click.option('--mix', default=DEFAULT_MIX, help='Scenario weights: generate, correct, wrong, crowd and spam.')
+@click.option('--answer', default=DEFAULT_ANSWER, help='Count submitted as the correct answer.')
+@click.option('--spam-count', default=20, help='Verifies per challenge in the spam scenario.')
+@click.option('--crowd-size', default=20, help='Challenges answered per iteration of the crowd scenario.')
+@click.option('--timeout', default=30.0, help='Per-request timeout in seconds.')
+@click.option('--json', 'json_path', type=click.Path(dir_okay=False), help='Write the results to this file.')
+def run_command(url, users, duration, mix, answer, spam_count, crowd_size, timeout, json_path):
+    """Run a mix of generate and verify scenarios."""
+    try:
+        summary, elapsed = run_load(url, users, duration, mix, answer, spam_count, timeout, crowd_size)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--mix')
+    print_summary(summary, elapsed)
+    if json_path:
+        write_json(json_path, summary, elapsed, {'url': url, 'users': users, 'mix': mix})
+
+@cli.command('replay')
+@click.argument('log', type=click.Path(exists=True, dir_okay=False))
+@click.option('--url', default='http://127.0.0.1:5000', help='Base URL of the server.')
+@click.option('--users', default=10, help='Virtual users, each replaying the whole log.')
+@click.option('--speed', type=float, default=None, help='Honour the log timing, sped up by this factor.')
+@click.option('--timeout', default=30.0, help='Per-request timeout in seconds.')
+@click.option('--json', 'json_path', type=click.Path(dir_okay=False), help='Write the results to this file.')
+def replay_command(log, url, users, speed, timeout, json_path):
+    """Replay a JSONL request log."""
+    entries = load_log(log)
+    if not entries:
+        click.echo(f'No requests with a method and path in {log}')
+        sys.exit(1)
+    summary, elapsed = replay_log(url, entries, users, speed, timeout)
+    print_summary(summary, elapsed)
+    if json_path:
+        write_json(json_path, summary, elapsed, {'url': url, 'users': users, 'log': log})
+
+if __name__ == '__main__':
+    cli()
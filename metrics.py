@@ -0,0 +1,175 @@
+import time
+import bisect
+import threading
+from flask import Response, request
+
+# Minimal Prometheus-style counters and histograms.
+#
+# Metrics are recorded only while `enabled` is set (see init_app); otherwise
+# every hook returns straight away, so leaving them in hot paths is cheap.
+# Values are kept per process, so renders done by the pre-rendering pool's
+# worker processes are not included.
+
+enabled = False
+
+# Latency buckets in seconds, from sub-millisecond queries to slow renders
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+REGISTRY = []
+
+class Counter:
+    """A monotonically increasing count, optionally split by labels"""
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        if not enabled:
+            return
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+class Histogram:
+    """Cumulative bucketed observations, optionally split by labels"""
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        if not enabled:
+            return
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts plus one overflow slot, then the sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def time(self, **labels):
+        """Context manager observing the duration of its block"""
+        if not enabled:
+            return _NOOP
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield self.name + '_bucket', {**labels, 'le': _format_value(bound)}, cumulative
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, cumulative
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+class _NoopTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_NOOP = _NoopTimer()
+
+# Generator
+GENERATE_SECONDS = Histogram('captcha_generate_seconds', 'End-to-end CAPTCHA render time.')
+STAGE_SECONDS = Histogram('captcha_generate_stage_seconds', 'CAPTCHA render time per generator stage.', ('stage',))
+PLACEMENT_ATTEMPTS = Counter('captcha_placement_attempts_total', 'Candidate placements evaluated per shape type.', ('shape',))
+PLACEMENT_FAILURES = Counter('captcha_placement_failures_total', 'Shapes that could not be placed.', ('shape',))
+GENERATE_RETRIES = Counter('captcha_generate_retries_total', 'Renders restarted because the target shape did not fit.')
+
+# Database
+QUERY_SECONDS = Histogram('captcha_db_query_seconds', 'Database statement time.', ('query',))
+COMMIT_SECONDS = Histogram('captcha_db_commit_seconds', 'Database commit time.', ('query',))
+
+# HTTP
+REQUEST_SECONDS = Histogram('captcha_http_request_seconds', 'Request handling time per endpoint.', ('endpoint',))
+REQUESTS = Counter('captcha_http_requests_total', 'Requests per endpoint and status.', ('endpoint', 'status'))
+RATE_LIMITED = Counter('captcha_rate_limited_total', 'Requests rejected by the rate limiter.', ('endpoint',))
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+def render_metrics():
+    """All registered metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        for name, labels, value in metric.samples():
+            lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+def _start_timer():
+    request.metrics_start = time.perf_counter()
+
+def _record_request(response):
+    start = getattr(request, 'metrics_start', None)
+    if start is not None and request.endpoint != 'metrics':
+        endpoint = request.endpoint or 'unknown'
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+        REQUESTS.inc(endpoint=endpoint, status=str(response.status_code))
+    return response
+
+def metrics_view():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+def init_app(app):
+    global enabled
+    app.config.setdefault('METRICS_ENABLED', False)
+
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    enabled = True
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,259 @@
+import os
+import mmap
+import time
+import struct
+import random
+from concurrent.futures import ProcessPoolExecutor
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from captcha_generator import render_captcha, GENERATOR_VERSION, ENCODERS, DEFAULT_ENCODER
+
+# Challenge packs: pre-rendered challenges in a single append-only file.
+#
+#   header   magic, format version, generator version, width, height, encoder
+#   images   encoded images back to back
+#   index    one fixed-width record per challenge: seed, offset, length,
+#            expected count and the expected answer (4 corners as grid x, y)
+#   trailer  index offset, challenge count, magic
+#
+# Appending truncates the old index and trailer, writes the new images after
+# the existing ones and then writes the extended index.
+
+MAGIC = b'CPAK'
+TRAILER_MAGIC = b'CPKI'
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct('<4sHHHH16s')
+RECORD = struct.Struct('<32sQIB8b')
+TRAILER = struct.Struct('<QI4s')
+
+class PackFormatError(ValueError):
+    """Raised when a file is not a readable challenge pack"""
+
+class PackRecord:
+    """Index entry of one challenge in a pack"""
+    __slots__ = ('seed', 'offset', 'length', 'expected_count', 'expected_answer')
+
+    def __init__(self, seed, offset, length, expected_count, expected_answer):
+        self.seed = seed
+        self.offset = offset
+        self.length = length
+        self.expected_count = expected_count
+        self.expected_answer = expected_answer
+
+    @classmethod
+    def unpack(cls, data, position=0):
+        seed, offset, length, expected_count, *answer = RECORD.unpack_from(data, position)
+        return cls(seed.rstrip(b'\0').decode('ascii'), offset, length, expected_count, answer)
+
+    def pack(self):
+        answer = list(self.expected_answer) + [0] * (8 - len(self.expected_answer))
+        return RECORD.pack(self.seed.encode('ascii'), self.offset, self.length, self.expected_count, *answer)
+
+def _read_layout(f):
+    """Read and check the header and trailer of an open pack file"""
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise PackFormatError('File is too short to be a challenge pack')
+    magic, version, generator_version, width, height, encoder = HEADER.unpack(header)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise PackFormatError('Not a challenge pack, or an unsupported pack version')
+
+    f.seek(-TRAILER.size, os.SEEK_END)
+    index_offset, count, trailer_magic = TRAILER.unpack(f.read(TRAILER.size))
+    if trailer_magic != TRAILER_MAGIC:
+        raise PackFormatError('Challenge pack is truncated or was not closed')
+
+    return {
+        'generator_version': generator_version,
+        'width': width,
+        'height': height,
+        'encoder': encoder.rstrip(b'\0').decode('ascii'),
+        'index_offset': index_offset,
+        'count': count,
+    }
+
+class PackWriter:
+    """
+    Append rendered challenges to a pack file.
+
+    The index is only written by close(), so a pack is readable once the
+    writer has been closed (or used as a context manager).
+    """
+    def __init__(self, path, encoder=DEFAULT_ENCODER, width=720, height=720):
+        self.path = path
+        self.records = []
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self._file = open(path, 'r+b')
+            layout = _read_layout(self._file)
+            if layout['generator_version'] != GENERATOR_VERSION:
+                raise PackFormatError('Cannot append to a pack rendered by a different generator version')
+            if (layout['encoder'], layout['width'], layout['height']) != (encoder, width, height):
+                raise PackFormatError('Cannot append challenges with a different encoder or size')
+
+            self._file.seek(layout['index_offset'])
+            index = self._file.read(layout['count'] * RECORD.size)
+            self.records = [PackRecord.unpack(index, i * RECORD.size) for i in range(layout['count'])]
+
+            # Drop the old index and trailer; they are rewritten on close
+            self._file.truncate(layout['index_offset'])
+            self._file.seek(layout['index_offset'])
+        else:
+            self._file = open(path, 'wb')
+            self._file.write(HEADER.pack(MAGIC, FORMAT_VERSION, GENERATOR_VERSION, width, height,
+                                         encoder.encode('ascii')))
+
+        self.encoder = encoder
+        self.width = width
+        self.height = height
+
+    def add(self, captcha_data):
+        """Append one rendered challenge"""
+        if captcha_data['image_format'] != self.encoder:
+            raise ValueError('Challenge was rendered with a different encoder than the pack')
+        if len(captcha_data['seed'].encode('ascii')) > 32:
+            raise ValueError('Pack seeds are limited to 32 ASCII characters')
+
+        offset = self._file.tell()
+        self._file.write(captcha_data['image_bytes'])
+        self.records.append(PackRecord(
+            captcha_data['seed'], offset, len(captcha_data['image_bytes']),
+            captcha_data['expected_count'], captcha_data['expected_answer']
+        ))
+
+    def close(self):
+        """Write the index and trailer"""
+        if self._file is None:
+            return
+        index_offset = self._file.tell()
+        self._file.write(b''.join(record.pack() for record in self.records))
+        self._file.write(TRAILER.pack(index_offset, len(self.records), TRAILER_MAGIC))
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class PackReader:
+    """
+    Read-only, memory-mapped view of a challenge pack.
+
+    Images are returned as memoryview slices of the mapping, so nothing is
+    copied until a response is written, and the pages are shared between
+    all worker processes that map the same pack.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            layout = _read_layout(f)
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.generator_version = layout['generator_version']
+        self.width = layout['width']
+        self.height = layout['height']
+        self.encoder = layout['encoder']
+        self.count = layout['count']
+        self._index_offset = layout['index_offset']
+        self._view = memoryview(self._mmap)
+
+        # Seeds are looked up whenever a pack image is served by seed
+        self._slots = {self.record(i).seed: i for i in range(self.count)}
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, seed):
+        return seed in self._slots
+
+    def record(self, slot):
+        """Index entry of the challenge in a slot"""
+        if not 0 <= slot < self.count:
+            raise IndexError('Pack slot out of range')
+        return PackRecord.unpack(self._mmap, self._index_offset + slot * RECORD.size)
+
+    def image(self, slot):
+        """Encoded image of the challenge in a slot, as a zero-copy memoryview"""
+        record = self.record(slot)
+        return self._view[record.offset:record.offset + record.length]
+
+    def find(self, seed):
+        """Slot of a seed, or None if it is not in the pack"""
+        return self._slots.get(seed)
+
+    def random_slot(self, rng=random):
+        return rng.randrange(self.count)
+
+    def captcha_data(self, slot):
+        """The challenge in a slot, in the dict form returned by generate_captcha"""
+        record = self.record(slot)
+        return {
+            'seed': record.seed,
+            'expected_count': record.expected_count,
+            'expected_answer': record.expected_answer,
+            'image_bytes': bytes(self.image(slot)),
+            'image_format': self.encoder,
+            'width': self.width,
+            'height': self.height,
+            'challenge_type': 'largest_rectangle',
+        }
+
+    def close(self):
+        self._view.release()
+        self._mmap.close()
+
+def get_pack():
+    """Return the app's challenge pack, or None if no pack is configured"""
+    return current_app.extensions.get('captcha_pack')
+
+@click.command('generate-pack')
+@click.option('--count', default=1000, help='Number of challenges to render.')
+@click.option('--workers', default=os.cpu_count(), help='Number of render processes.')
+@click.option('--encoder', type=click.Choice(sorted(ENCODERS)), default=None,
+              help='Image encoder (defaults to the first of CAPTCHA_IMAGE_FORMATS).')
+@click.option('--output', type=click.Path(dir_okay=False), default=None,
+              help='Pack file to append to (defaults to CAPTCHA_PACK).')
+@with_appcontext
+def generate_pack_command(count, workers, encoder, output):
+    """Render challenges in parallel and append them to a challenge pack."""
+    output = output or current_app.config['CAPTCHA_PACK']
+    if not output:
+        raise click.UsageError('Set CAPTCHA_PACK or pass --output')
+    encoder = encoder or current_app.config['CAPTCHA_IMAGE_FORMATS'][0]
+
+    start = time.perf_counter()
+    with PackWriter(output, encoder) as writer, ProcessPoolExecutor(max_workers=workers) as executor:
+        renders = executor.map(render_captcha, [None] * count, [encoder] * count, chunksize=16)
+        with click.progressbar(renders, length=count, label='Rendering') as bar:
+            for captcha_data in bar:
+                writer.add(captcha_data)
+
+    elapsed = time.perf_counter() - start
+    click.echo(f'Wrote {count} challenges to {output} ({len(writer.records)} in total) '
+               f'in {elapsed:.1f}s, {count / elapsed:.0f} per second.')
+
+def init_app(app):
+    app.config.setdefault('CAPTCHA_PACK', None)
+    app.cli.add_command(generate_pack_command)
+
+    path = app.config['CAPTCHA_PACK']
+    if not path or not os.path.exists(path):
+        return
+
+    try:
+        pack = PackReader(path)
+    except PackFormatError as e:
+        app.logger.warning('Ignoring challenge pack %s: %s', path, e)
+        return
+
+    if pack.generator_version != GENERATOR_VERSION or pack.count == 0:
+        app.logger.warning('Ignoring challenge pack %s: empty or rendered by another generator version', path)
+        pack.close()
+        return
+
+    app.extensions['captcha_pack'] = pack
@@ -0,0 +1,219 @@
+import os
+import math
+import mmap
+import time
+import struct
+import hashlib
+import threading
+import click
+from contextlib import contextmanager
+from flask import current_app, request, jsonify
+from flask.cli import with_appcontext
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Per-IP, per-endpoint token buckets shared by every worker process on a host.
+#
+# Buckets live in a fixed-size hash table in a memory-mapped file, so a check
+# is a hash, a probe of at most PROBE_LENGTH slots and one write, done under
+# an exclusive flock() of the file. Each slot holds a 16-byte key digest, the
+# tokens left and the time of the last update. A key that has been idle for
+# idle_after seconds has a full bucket again, so its slot is simply reused;
+# when a key's probe window has no free slot, the least recently used bucket
+# in it is evicted. Memory use is fixed by the number of slots.
+
+MAGIC = b'CRLT'
+HEADER = struct.Struct('<4sIQQ8x')  # magic, slots, rejected, evicted
+SLOT = struct.Struct('<16sdd')  # key digest, tokens, updated
+EMPTY = bytes(16)
+
+PROBE_LENGTH = 8
+
+class RateLimiter:
+    """
+    Token buckets keyed by (endpoint, client address) in a shared file.
+
+    limits maps endpoint names to (tokens per second, burst size).
+    """
+    def __init__(self, path, limits, slots=65536, idle_after=600):
+        self.path = path
+        self.limits = limits
+        self.slots = slots
+        self.idle_after = idle_after
+        self.size = HEADER.size + slots * SLOT.size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._mmap = None
+
+    def allow(self, endpoint, address, cost=1):
+        """
+        Take cost tokens from the bucket of an endpoint and address. Returns
+        (allowed, seconds until enough tokens are available)
+        """
+        limit = self.limits.get(endpoint)
+        if limit is None:
+            return True, 0.0
+        rate, burst = limit
+        # A request costing more than the burst could never pass; it takes a
+        # full bucket instead
+        cost = min(cost, burst)
+
+        key = hashlib.blake2b(f'{endpoint}\0{address}'.encode(), digest_size=16).digest()
+        home = int.from_bytes(key[:8], 'little') % self.slots
+        now = time.time()
+
+        with self._locked() as table:
+            position, tokens, updated = self._find(table, key, home, now)
+            # Refill for the time since the last update; clocks going
+            # backwards never add tokens
+            tokens = min(burst, tokens + max(now - updated, 0.0) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            else:
+                self._count(table, rejected=1)
+            SLOT.pack_into(table, HEADER.size + position * SLOT.size, key, tokens, now)
+
+        if not allowed:
+            metrics.RATE_LIMITED.inc(endpoint=endpoint)
+            return False, (cost - tokens) / rate
+        return True, 0.0
+
+    def stats(self):
+        """Host-wide counts of rejected requests and evicted buckets"""
+        with self._locked() as table:
+            _, slots, rejected, evicted = HEADER.unpack_from(table)
+            in_use = sum(
+                1 for position in range(slots)
+                if table[HEADER.size + position * SLOT.size:HEADER.size + position * SLOT.size + 16] != EMPTY
+            )
+        return {'slots': slots, 'in_use': in_use, 'rejected': rejected, 'evicted': evicted}
+
+    def close(self):
+        if self._mmap is not None and self._pid == os.getpid():
+            self._mmap.close()
+            os.close(self._fd)
+        self._mmap = None
+        self._fd = None
+
+    def _find(self, table, key, home, now):
+        # Returns the slot to use with its current tokens and update time; a
+        # new or reused slot starts from an empty record, which refills to a
+        # full bucket
+        reusable = None
+        oldest = None
+        for probe in range(PROBE_LENGTH):
+            position = (home + probe) % self.slots
+            digest, tokens, updated = SLOT.unpack_from(table, HEADER.size + position * SLOT.size)
+            if digest == key:
+                return position, tokens, updated
+            if reusable is None and (digest == EMPTY or now - updated > self.idle_after):
+                reusable = position
+            if oldest is None or updated < oldest[1]:
+                oldest = (position, updated)
+
+        if reusable is None:
+            reusable = oldest[0]
+            self._count(table, evicted=1)
+        return reusable, 0.0, float('-inf')
+
+    def _count(self, table, rejected=0, evicted=0):
+        magic, slots, total_rejected, total_evicted = HEADER.unpack_from(table)
+        HEADER.pack_into(table, 0, magic, slots, total_rejected + rejected, total_evicted + evicted)
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            table = self._open()
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield table
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _open(self):
+        # flock() locks belong to the open file, which a forked child would
+        # share with its parent, so each process opens the file itself
+        if self._mmap is not None and self._pid == os.getpid():
+            return self._mmap
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(fd, HEADER.size, 0)
+            valid = len(header) == HEADER.size and HEADER.unpack(header)[:2] == (MAGIC, self.slots)
+            if not valid or os.fstat(fd).st_size != self.size:
+                # New file, or one laid out for a different table size
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+                os.pwrite(fd, HEADER.pack(MAGIC, self.slots, 0, 0), 0)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+        self._fd = fd
+        self._mmap = mmap.mmap(fd, self.size)
+        self._pid = os.getpid()
+        return self._mmap
+
+def retry_after_header(seconds):
+    """Retry-After value for a wait of seconds, rounded up to whole seconds"""
+    return str(max(1, math.ceil(seconds)))
+
+def get_rate_limiter():
+    """Return the app's rate limiter, or None if rate limiting is disabled"""
+    return current_app.extensions.get('rate_limiter')
+
+def _check_rate_limit():
+    limiter = current_app.extensions['rate_limiter']
+    cost = current_app.extensions['rate_limit_costs'].get(request.endpoint)
+    allowed, retry_after = limiter.allow(request.endpoint, request.remote_addr, cost() if cost else 1)
+    if allowed:
+        return None
+    response = jsonify({'success': False, 'message': 'Too many requests, try again shortly'})
+    response.status_code = 429
+    response.headers['Retry-After'] = retry_after_header(retry_after)
+    return response
+
+@click.command('rate-limit-stats')
+@with_appcontext
+def rate_limit_stats_command():
+    """Show the host-wide rate limiter counters."""
+    limiter = get_rate_limiter()
+    if limiter is None:
+        raise click.UsageError('Rate limiting is disabled; set RATE_LIMIT_ENABLED')
+    stats = limiter.stats()
+    click.echo(f"{stats['in_use']} of {stats['slots']} buckets in use, "
+               f"{stats['rejected']} requests rejected, {stats['evicted']} buckets evicted.")
+
+def init_app(app):
+    app.config.setdefault('RATE_LIMIT_ENABLED', False)
+    app.config.setdefault('RATE_LIMITS', {})
+    app.config.setdefault('RATE_LIMIT_FILE', os.path.join(app.instance_path, 'ratelimit.bin'))
+    app.config.setdefault('RATE_LIMIT_SLOTS', 65536)
+    app.config.setdefault('RATE_LIMIT_IDLE_AFTER', 600)
+    app.cli.add_command(rate_limit_stats_command)
+    # Endpoints charging more than one token per request map to a function
+    # returning the cost of the current request
+    app.extensions.setdefault('rate_limit_costs', {})
+
+    if not app.config['RATE_LIMIT_ENABLED']:
+        return
+
+    app.extensions['rate_limiter'] = RateLimiter(
+        app.config['RATE_LIMIT_FILE'],
+        {endpoint: tuple(limit) for endpoint, limit in app.config['RATE_LIMITS'].items()},
+        slots=app.config['RATE_LIMIT_SLOTS'],
+        idle_after=app.config['RATE_LIMIT_IDLE_AFTER'],
+    )
+    # Registered ahead of the views, so rejected requests never render anything
+    app.before_request(_check_rate_limit)
@@ -0,0 +1,63 @@
+import time
+import threading
+from collections import OrderedDict
+from flask import current_app
+
+# Challenges are consumed in the database on their first verify. Consumed
+# challenges are also remembered here for a while, so replays of a used
+# challenge are turned away without touching SQLite. The cache is per
+# process; a replay another worker has not seen yet still ends at the
+# database, which rejects it atomically.
+
+class ExpiringSet:
+    """
+    Set of keys that are forgotten ttl seconds after they were added.
+
+    At most max_size keys are kept; the oldest are dropped first. Keys are
+    kept in insertion order, so expired keys are always at the front and
+    both add and lookup are O(1) amortized.
+    """
+    def __init__(self, max_size=100000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._expiry = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        now = time.monotonic()
+        with self._lock:
+            self._expiry.pop(key, None)
+            self._expiry[key] = now + self.ttl
+            self._expire(now)
+
+    def __contains__(self, key):
+        now = time.monotonic()
+        with self._lock:
+            expiry = self._expiry.get(key)
+            if expiry is None:
+                return False
+            if expiry <= now:
+                self._expire(now)
+                return False
+            return True
+
+    def __len__(self):
+        return len(self._expiry)
+
+    def _expire(self, now):
+        while self._expiry:
+            key, expiry = next(iter(self._expiry.items()))
+            if expiry > now and len(self._expiry) <= self.max_size:
+                break
+            del self._expiry[key]
+
+def get_replay_cache():
+    """Return the app's cache of consumed challenges"""
+    return current_app.extensions['replay_cache']
+
+def init_app(app):
+    app.config.setdefault('CAPTCHA_REPLAY_CACHE_SIZE', 100000)
+    app.config.setdefault('CAPTCHA_REPLAY_CACHE_TTL', 3600)
+    app.extensions['replay_cache'] = ExpiringSet(
+        app.config['CAPTCHA_REPLAY_CACHE_SIZE'], app.config['CAPTCHA_REPLAY_CACHE_TTL']
+    )
@@ -0,0 +1,278 @@
+import os
+import time
+import logging
+import threading
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from database import connect, database_paths
+
+# Retention: raw responses and expired challenges are rolled up into daily
+# tables and then deleted.
+#
+# Every batch is rolled up and deleted in its own short IMMEDIATE transaction,
+# so writers only ever wait for one batch, and several processes compacting
+# the same file never count a row twice. Consensus answers come from
+# response_tallies, which are kept until their captcha expires, so deleting
+# raw responses early does not change verification.
+
+# Creates the rollup tables on databases initialized before they existed
+ROLLUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS daily_responses (
+    day TEXT NOT NULL,
+    answer INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (day, answer)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS daily_ip_responses (
+    day TEXT NOT NULL,
+    ip_address TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (day, ip_address)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS daily_captchas (
+    day TEXT PRIMARY KEY,
+    captchas INTEGER NOT NULL,
+    answered INTEGER NOT NULL,
+    consensus_expected INTEGER NOT NULL
+);
+"""
+
+# Add the responses matched by a WHERE clause to the daily rollups
+ROLLUP_RESPONSES = """
+INSERT INTO daily_responses (day, answer, count)
+SELECT date(created_at), user_count, COUNT(*) FROM responses WHERE {where} GROUP BY 1, 2
+ON CONFLICT (day, answer) DO UPDATE SET count = count + excluded.count
+"""
+
+ROLLUP_IPS = """
+INSERT INTO daily_ip_responses (day, ip_address, count)
+SELECT date(created_at), ip_address, COUNT(*) FROM responses WHERE {where} GROUP BY 1, 2
+ON CONFLICT (day, ip_address) DO UPDATE SET count = count + excluded.count
+"""
+
+def _cutoff(days):
+    return f'-{float(days)} days'
+
+def _rollup_and_delete_responses(db, where, params):
+    for statement in (ROLLUP_RESPONSES, ROLLUP_IPS):
+        db.execute(statement.format(where=where), params)
+    return db.execute(f'DELETE FROM responses WHERE {where}', params).rowcount
+
+def compact_responses(db, days, batch_size=500, pause=0.05):
+    """Roll up and delete responses older than days, batch by batch; returns the number deleted"""
+    deleted = 0
+    while True:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # Ids grow with created_at, so the oldest rows come first
+            bounds = db.execute(
+                '''
+                SELECT MIN(id), MAX(id) FROM (
+                    SELECT id FROM responses WHERE created_at < datetime('now', ?) ORDER BY id LIMIT ?
+                )
+                ''',
+                (_cutoff(days), batch_size)
+            ).fetchone()
+            if bounds[0] is None:
+                db.rollback()
+                return deleted
+            deleted += _rollup_and_delete_responses(
+                db, "id BETWEEN ? AND ? AND created_at < datetime('now', ?)", (*bounds, _cutoff(days))
+            )
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+        time.sleep(pause)
+
+def compact_captchas(db, days, batch_size=500, pause=0.05):
+    """
+    Roll up and delete captchas older than days, together with their
+    remaining responses and consensus tallies; returns the number deleted
+    """
+    deleted = 0
+    expired = "SELECT id FROM captchas WHERE id BETWEEN ? AND ? AND created_at < datetime('now', ?)"
+    while True:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            bounds = db.execute(
+                '''
+                SELECT MIN(id), MAX(id) FROM (
+                    SELECT id FROM captchas WHERE created_at < datetime('now', ?) ORDER BY id LIMIT ?
+                )
+                ''',
+                (_cutoff(days), batch_size)
+            ).fetchone()
+            if bounds[0] is None:
+                db.rollback()
+                return deleted
+            params = (*bounds, _cutoff(days))
+
+            _rollup_and_delete_responses(db, f'captcha_id IN ({expired})', params)
+            db.execute(
+                f'''
+                INSERT INTO daily_captchas (day, captchas, answered, consensus_expected)
+                SELECT date(c.created_at), COUNT(*), COUNT(m.captcha_id),
+                       COALESCE(SUM(m.answer = c.expected_count), 0)
+                FROM captchas c LEFT JOIN response_modes m ON m.captcha_id = c.id
+                WHERE c.id IN ({expired})
+                GROUP BY 1
+                ON CONFLICT (day) DO UPDATE SET
+                    captchas = captchas + excluded.captchas,
+                    answered = answered + excluded.answered,
+                    consensus_expected = consensus_expected + excluded.consensus_expected
+                ''',
+                params
+            )
+            for table in ('response_tallies', 'response_modes'):
+                db.execute(f'DELETE FROM {table} WHERE captcha_id IN ({expired})', params)
+            deleted += db.execute(f'DELETE FROM captchas WHERE id IN ({expired})', params).rowcount
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+        time.sleep(pause)
+
+def compact_consumed_tokens(db, batch_size=500, pause=0.05):
+    """Delete consumed token nonces whose tokens have expired anyway"""
+    tables = {row['name'] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if 'consumed_tokens' not in tables:
+        return
+    while db.execute(
+        '''
+        DELETE FROM consumed_tokens WHERE nonce IN (
+            SELECT nonce FROM consumed_tokens WHERE expires_at < datetime('now') LIMIT ?
+        )
+        ''',
+        (batch_size,)
+    ).rowcount:
+        db.commit()
+        time.sleep(pause)
+    db.commit()
+
+def compact(path, responses_days=None, captchas_days=None, batch_size=500, pause=0.05, vacuum=False):
+    """
+    Apply the retention periods to one database file, returning the number
+    of deleted responses and captchas
+    """
+    db = connect(path)
+    try:
+        db.executescript(ROLLUP_SCHEMA)
+        result = {'responses': 0, 'captchas': 0}
+        if responses_days is not None:
+            result['responses'] = compact_responses(db, responses_days, batch_size, pause)
+        if captchas_days is not None:
+            result['captchas'] = compact_captchas(db, captchas_days, batch_size, pause)
+        compact_consumed_tokens(db, batch_size, pause)
+
+        # Free pages are handed back to the file system when the database
+        # was created with auto_vacuum=INCREMENTAL; VACUUM always does it
+        if vacuum:
+            db.execute('VACUUM')
+        else:
+            # sqlite3 steps a statement only once, which frees a single page;
+            # executescript runs the pragma to completion
+            db.executescript('PRAGMA incremental_vacuum')
+        db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return result
+    finally:
+        db.close()
+
+class RetentionWorker:
+    """
+    Background thread compacting every database file of an app once per
+    interval seconds
+    """
+    def __init__(self, paths, responses_days, captchas_days, interval=3600, batch_size=500, pause=0.05,
+                 logger=None):
+        self.paths = paths
+        self.responses_days = responses_days
+        self.captchas_days = captchas_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.logger = logger or logging.getLogger(__name__)
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        # Threads do not survive fork(), so each worker process starts its own
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._stop = threading.Event()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+                self._thread.start()
+
+    def close(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and self._pid == os.getpid():
+            self._stop.set()
+            thread.join()
+
+    def run_once(self):
+        for path in self.paths:
+            compact(path, self.responses_days, self.captchas_days, self.batch_size, self.pause)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                # A busy or locked database is retried on the next interval
+                self.logger.exception('Retention compaction failed; retrying in %s seconds', self.interval)
+
+@click.command('compact')
+@click.option('--responses-days', type=float, default=None,
+              help='Keep raw responses for this many days (defaults to RETENTION_RESPONSES_DAYS).')
+@click.option('--captchas-days', type=float, default=None,
+              help='Keep captchas for this many days (defaults to RETENTION_CAPTCHAS_DAYS).')
+@click.option('--batch-size', default=None, type=int, help='Rows deleted per transaction.')
+@click.option('--vacuum', is_flag=True, help='Rebuild the database files afterwards to shrink them.')
+@with_appcontext
+def compact_command(responses_days, captchas_days, batch_size, vacuum):
+    """Roll up and delete expired captchas and responses."""
+    config = current_app.config
+    if responses_days is None:
+        responses_days = config['RETENTION_RESPONSES_DAYS']
+    if captchas_days is None:
+        captchas_days = config['RETENTION_CAPTCHAS_DAYS']
+    batch_size = batch_size or config['RETENTION_BATCH_SIZE']
+
+    for path in database_paths(config):
+        result = compact(path, responses_days, captchas_days, batch_size, config['RETENTION_BATCH_PAUSE'], vacuum)
+        click.echo(f"{path}: deleted {result['responses']} responses and {result['captchas']} captchas.")
+
+def _start_worker():
+    current_app.extensions['retention_worker'].ensure_started()
+
+def init_app(app):
+    app.config.setdefault('RETENTION_RESPONSES_DAYS', None)
+    app.config.setdefault('RETENTION_CAPTCHAS_DAYS', None)
+    app.config.setdefault('RETENTION_INTERVAL', 3600)
+    app.config.setdefault('RETENTION_BATCH_SIZE', 500)
+    app.config.setdefault('RETENTION_BATCH_PAUSE', 0.05)
+    app.cli.add_command(compact_command)
+
+    responses_days = app.config['RETENTION_RESPONSES_DAYS']
+    captchas_days = app.config['RETENTION_CAPTCHAS_DAYS']
+    if not app.config['RETENTION_INTERVAL'] or (responses_days is None and captchas_days is None):
+        return
+
+    worker = RetentionWorker(
+        database_paths(app.config), responses_days, captchas_days,
+        interval=app.config['RETENTION_INTERVAL'],
+        batch_size=app.config['RETENTION_BATCH_SIZE'],
+        pause=app.config['RETENTION_BATCH_PAUSE'],
+        logger=app.logger,
+    )
+    app.extensions['retention_worker'] = worker
+    # Started by the first request, so each server process runs its own
+    app.before_request(_start_worker)
@@ -1,11 +1,19 @@
 DROP TABLE IF EXISTS captchas;
 DROP TABLE IF EXISTS responses;
+DROP TABLE IF EXISTS response_tallies;
+DROP TABLE IF EXISTS response_modes;
+DROP TABLE IF EXISTS daily_responses;
+DROP TABLE IF EXISTS daily_ip_responses;
+DROP TABLE IF EXISTS daily_captchas;
+DROP TABLE IF EXISTS consumed_tokens;
 
 CREATE TABLE captchas (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     seed TEXT NOT NULL,
     expected_count INTEGER NOT NULL,
-    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    -- Set by the first verify; a challenge can only be answered once
+    consumed_at TIMESTAMP
 );
 
 CREATE TABLE responses (
@@ -15,4 +23,55 @@ CREATE TABLE responses (
     ip_address TEXT NOT NULL,
     created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (captcha_id) REFERENCES captchas (id)
-); 
\ No newline at end of file
+);
+
+-- Nonces of stateless challenge tokens that have been verified, kept until
+-- the token would have expired
+CREATE TABLE consumed_tokens (
+    nonce TEXT PRIMARY KEY,
+    expires_at TIMESTAMP NOT NULL
+) WITHOUT ROWID;
+
+-- Stateless challenges find their row by seed
+CREATE INDEX captchas_seed ON captchas (seed);
+
+CREATE INDEX responses_captcha_id ON responses (captcha_id);
+
+-- Number of responses per (captcha, answer), kept up to date on insert
+CREATE TABLE response_tallies (
+    captcha_id INTEGER NOT NULL,
+    answer INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (captcha_id, answer)
+) WITHOUT ROWID;
+
+-- Most common answer per captcha, so consensus is a primary key lookup
+CREATE TABLE response_modes (
+    captcha_id INTEGER PRIMARY KEY,
+    answer INTEGER NOT NULL,
+    count INTEGER NOT NULL
+);
+
+-- Daily rollups of responses and captchas deleted by retention
+CREATE TABLE daily_responses (
+    day TEXT NOT NULL,
+    answer INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (day, answer)
+) WITHOUT ROWID;
+
+CREATE TABLE daily_ip_responses (
+    day TEXT NOT NULL,
+    ip_address TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (day, ip_address)
+) WITHOUT ROWID;
+
+-- Expired captchas per creation day, how many got a response and how many
+-- ended with the expected count as their consensus answer
+CREATE TABLE daily_captchas (
+    day TEXT PRIMARY KEY,
+    captchas INTEGER NOT NULL,
+    answered INTEGER NOT NULL,
+    consensus_expected INTEGER NOT NULL
+);
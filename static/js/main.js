@@ -91,7 +91,7 @@ new Vue({
             })
             .then(response => response.json())
             .then(data => {
-                this.captchaImage = data.image_data;
+                this.captchaImage = data.image_url;
                 this.captchaId = data.captcha_id;
                 this.loading = false;
                 // Draw lines after image loads
@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """The Flask app on a fresh database, rendering inline"""
+    from app import app
+    from database import init_db
+    from replay_cache import ExpiringSet
+
+    monkeypatch.setitem(app.config, 'TESTING', True)
+    monkeypatch.setitem(app.config, 'DATABASE', str(tmp_path / 'geometric_captcha.sqlite'))
+    for name in ('captcha_pool', 'captcha_pack', 'seed_catalog', 'rate_limiter'):
+        if name in app.extensions:
+            monkeypatch.delitem(app.extensions, name)
+    monkeypatch.setitem(app.extensions, 'replay_cache', ExpiringSet())
+
+    with app.app_context():
+        init_db()
+    return app
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,32 @@
+import time
+
+from captcha_pool import CaptchaPool
+
+def wait_for(condition, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('Timed out waiting for the pool')
+        time.sleep(0.05)
+
+def test_pool_recovers_from_a_killed_worker():
+    pool = CaptchaPool(low_watermark=1, high_watermark=2, workers=1)
+    try:
+        pool.refill()
+        wait_for(lambda: pool.stats()['ready'] == 2)
+
+        for process in list(pool._executor._processes.values()):
+            process.kill()
+            process.join()
+
+        # Draining the pool submits to the broken executor; the challenges
+        # are still served, rendered inline once the pool runs dry
+        for _ in range(4):
+            assert pool.get()['expected_count'] > 0
+
+        wait_for(lambda: pool.stats()['ready'] > 0)
+        assert pool.stats()['pending'] >= 0
+        assert pool.get()['expected_count'] > 0
+        assert pool.stats()['hits'] >= 3
+    finally:
+        pool.close()
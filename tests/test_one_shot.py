@@ -0,0 +1,129 @@
+import json
+import sqlite3
+import threading
+
+import pytest
+
+from replay_cache import ExpiringSet
+
+ANSWER = {'count': 4}
+
+@pytest.fixture(params=[False, True], ids=['stateful', 'stateless'])
+def stateless(request, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'CAPTCHA_STATELESS', request.param)
+    return request.param
+
+def verify(client, body=ANSWER):
+    return client.post('/verify-captcha', json=body).json
+
+def replay(app, cookie):
+    """A client sending a session cookie saved before the verify"""
+    client = app.test_client()
+    client.set_cookie('session', cookie)
+    return verify(client)
+
+def forget_replays(app, monkeypatch):
+    # As if the replay reached a worker that has not seen the first verify
+    monkeypatch.setitem(app.extensions, 'replay_cache', ExpiringSet())
+
+def query(app, sql):
+    db = sqlite3.connect(app.config['DATABASE'])
+    try:
+        return db.execute(sql).fetchall()
+    finally:
+        db.close()
+
+def test_first_verify_consumes_the_challenge(app, client, stateless):
+    client.post('/generate-captcha')
+    assert verify(client)['success']
+    assert verify(client)['message'] == 'No CAPTCHA session found'
+
+    assert query(app, 'SELECT COUNT(*) FROM responses') == [(1,)]
+    if stateless:
+        assert query(app, 'SELECT COUNT(*) FROM consumed_tokens') == [(1,)]
+    else:
+        assert query(app, 'SELECT consumed_at IS NOT NULL FROM captchas') == [(1,)]
+
+def test_replay_of_a_rolled_back_session_is_rejected(app, client, stateless, monkeypatch):
+    client.post('/generate-captcha')
+    cookie = client.get_cookie('session').value
+    assert verify(client)['success']
+
+    # Rejected from the replay cache, then by the database alone
+    assert replay(app, cookie)['message'] == 'CAPTCHA already used'
+    forget_replays(app, monkeypatch)
+    assert replay(app, cookie)['message'] == 'CAPTCHA already used'
+
+    assert query(app, 'SELECT COUNT(*) FROM responses') == [(1,)]
+
+def test_concurrent_verifies_have_one_winner(app, client, stateless):
+    client.post('/generate-captcha')
+    cookie = client.get_cookie('session').value
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(replay(app, cookie))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(result['success'] for result in results) == 1
+    assert sum(result['message'] == 'CAPTCHA already used' for result in results) == 7
+    assert query(app, 'SELECT COUNT(*) FROM responses') == [(1,)]
+
+def test_batch_tickets_are_consumed_once(app, client, stateless, monkeypatch):
+    lines = client.post('/generate-captcha/batch?count=2').get_data(as_text=True).splitlines()
+    ticket = {**ANSWER, 'ticket': json.loads(lines[0])['ticket']}
+
+    assert verify(client, ticket)['success']
+    assert verify(client, ticket)['message'] == 'CAPTCHA already used'
+    forget_replays(app, monkeypatch)
+    assert verify(client, ticket)['message'] == 'CAPTCHA already used'
+
+# Schema of databases created before consensus tallies and one-shot consumption
+OLD_SCHEMA = """
+CREATE TABLE captchas (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    seed TEXT NOT NULL,
+    expected_count INTEGER NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE responses (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    captcha_id INTEGER NOT NULL,
+    user_count INTEGER NOT NULL,
+    ip_address TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (captcha_id) REFERENCES captchas (id)
+);
+
+INSERT INTO captchas (seed, expected_count) VALUES ('old-seed', 4);
+"""
+
+def test_one_shot_migration_upgrades_an_existing_database(app, client, tmp_path, monkeypatch):
+    path = tmp_path / 'old.sqlite'
+    db = sqlite3.connect(path)
+    db.executescript(OLD_SCHEMA)
+    db.close()
+    monkeypatch.setitem(app.config, 'DATABASE', str(path))
+
+    runner = app.test_cli_runner()
+    assert runner.invoke(args=['migrate-tallies']).exit_code == 0
+    # Running it again must be harmless
+    for _ in range(2):
+        result = runner.invoke(args=['migrate-one-shot'])
+        assert result.exit_code == 0, result.output
+
+    columns = [row[1] for row in query(app, 'PRAGMA table_info(captchas)')]
+    assert 'consumed_at' in columns
+    assert query(app, "SELECT name FROM sqlite_master WHERE name IN ('consumed_tokens', 'captchas_seed') "
+                      "ORDER BY name") == [('captchas_seed',), ('consumed_tokens',)]
+
+    # Rows from before the migration are consumed once like new ones
+    with client.session_transaction() as session:
+        session['captcha_id'] = 1
+    assert verify(client)['success']
+    with client.session_transaction() as session:
+        session['captcha_id'] = 1
+    assert verify(client)['message'] == 'CAPTCHA already used'